@@ -5,7 +5,9 @@
 # The candy server will run an RPC server in the kaa mainloop and will
 # execute commands. A widget is created and prepared in the kaa main
 # loop; everything else, including imports is done in the clutter
-# thread.
+# thread. The sync call returns before the clutter thread is done and
+# the next sync can be prepared in the meantime. Each sync is
+# acknowledged with the sync-done event.
 #
 # -----------------------------------------------------------------------------
 # kaa-candy - Fourth generation Canvas System using Clutter as backend
@@ -56,11 +58,115 @@ import kaa.rpc
 import kaa.candy.core
 sys.modules['core'] = kaa.candy.core
 
+import kaa.candy.ringbuffer
+
+class FrameScheduler(object):
+    """
+    Timing of the sync work in the clutter thread. The frame starts
+    after the stage is painted and the sync may use a part of the
+    frame interval before clutter needs the thread again.
+    """
+    def __init__(self):
+        self.stats = {
+            'frames': 0, 'budget': 0.0, 'work': 0.0, 'calls': 0,
+            'deferred': 0, 'deferred_calls': 0, 'overruns': 0, 'call_time': 0.0 }
+        self.configure({})
+        self.frame_start = time.time()
+        # work done in the current frame
+        self.work = 0.0
+        self.calls = 0
+        # average time of one call in the queue
+        self.call_time = 0.0
+
+    def configure(self, options):
+        """
+        Set frame rate and the fraction of the frame used for syncing
+        """
+        self.interval = 1.0 / options.get('frame_rate', 60)
+        self.budget = self.interval * options.get('frame_budget', 0.5)
+        self.stats['budget'] = self.budget * 1000
+
+    def attach(self, stage):
+        """
+        Use the paint signals of the clutter stage as frame start
+        """
+        try:
+            stage.connect('after-paint', self.new_frame)
+        except TypeError:
+            # clutter < 1.20
+            stage.connect_after('paint', self.new_frame)
+
+    def new_frame(self, *args):
+        """
+        Callback after the stage is painted
+        """
+        if self.work > self.budget:
+            self.stats['overruns'] += 1
+        self.stats['frames'] += 1
+        self.stats['work'] = self.work * 1000
+        self.stats['calls'] = self.calls
+        self.frame_start = time.time()
+        self.work = 0.0
+        self.calls = 0
+
+    def remaining(self):
+        """
+        Return the time left for syncing in the current frame
+        """
+        now = time.time()
+        if now - self.frame_start > self.interval:
+            # nothing painted for a full frame, the stage is idle
+            self.new_frame()
+        return self.frame_start + self.budget - now
+
+    def fits(self, calls):
+        """
+        Check if the given number of calls can be done in this frame
+        """
+        remaining = self.remaining()
+        return not self.calls or calls * self.call_time <= remaining
+
+    def account(self, calls, secs):
+        """
+        Add the time used by the given number of calls
+        """
+        self.work += secs
+        self.calls += calls
+        self.call_time = 0.9 * self.call_time + 0.1 * secs / calls
+        self.stats['call_time'] = self.call_time * 1000
+
+    def defer(self, calls):
+        """
+        Defer the calls to the next frame. Returns the time to wait in ms.
+        """
+        self.stats['deferred'] += 1
+        self.stats['deferred_calls'] += calls
+        return max(1, int((self.frame_start + self.interval - time.time()) * 1000))
+
+# global scheduler object
+scheduler = FrameScheduler()
+
 class Mainloop(object):
     """
     Clutter mainloop.
     """
 
+    # ring buffer for position updates and records waiting for their
+    # rpc sync to be applied first
+    ring = None
+    ring_pending = []
+
+    # sequence number of the last sync applied to the clutter objects
+    sync_applied = 0
+
+    def __init__(self):
+        # batches waiting for the clutter thread
+        self.batches = []
+        self.scheduled = False
+        self.lock = threading.Lock()
+        # batch partly applied in the clutter thread
+        self.started = None
+
     def run(self):
         # Import clutter only in the gobject thread
         # This function will be the running mainloop
@@ -92,48 +198,179 @@ class Mainloop(object):
         if hasattr(sys.modules[name], 'init'):
             sys.modules[name].init(server)
 
-    def sync(self, queue, event):
+    def set_ring(self, ring, server):
+        """
+        Start reading the position ring buffer
+        Executed inside the clutter thread
+        """
+        self.ring = ring
+        self.ring_pending = []
+        self.server = server
+        gobject.timeout_add(int(scheduler.interval * 1000), self.drain_ring)
+
+    def drain_ring(self, seq=None):
+        """
+        Apply the records from the ring buffer written after the rpc
+        sync seq or earlier ones. The default is the last applied
+        sync. Records written after an rpc sync not yet applied have
+        to wait.
+        Executed inside the clutter thread
+        """
+        if self.ring is None:
+            return False
+        if seq is None:
+            seq = self.sync_applied
+        records = self.ring_pending + self.ring.read()
+        self.ring_pending = []
+        for record in records:
+            if record[0] > seq:
+                self.ring_pending.append(record)
+                continue
+            widget = self.server.widgets.get(record[1])
+            if widget is None or widget.obj is None:
+                # widget deleted in the meantime
+                continue
+            try:
+                self.apply_record(widget, *record[2:])
+            except Exception, e:
+                log.exception('ring buffer error: %s', record)
+        return True
+
+    def apply_record(self, widget, flags, mode, x, y, opacity, scale_x, scale_y, duration):
+        """
+        Apply one ring buffer record to the widget
+        Executed inside the clutter thread
+        """
+        if flags & kaa.candy.ringbuffer.ANIMATE:
+            args = []
+            if flags & kaa.candy.ringbuffer.POSITION:
+                args.extend(('x', x, 'y', y))
+            if flags & kaa.candy.ringbuffer.OPACITY:
+                args.extend(('opacity', opacity))
+            if flags & kaa.candy.ringbuffer.SCALE:
+                args.extend(('scale_x', scale_x, 'scale_y', scale_y))
+            mode = kaa.candy.ringbuffer.ANIMATION_MODES[mode]
+            return widget.animate(mode, duration / 1000.0, *args)
+        if flags & kaa.candy.ringbuffer.POSITION:
+            widget.x, widget.y = x, y
+            widget.set_position()
+        # opacity and scale use the update path of the widget like an
+        # rpc sync to let subclasses handle them
+        modified = {}
+        if flags & kaa.candy.ringbuffer.OPACITY:
+            modified['opacity'] = opacity
+        if flags & kaa.candy.ringbuffer.SCALE:
+            modified['scale_x'], modified['scale_y'] = scale_x, scale_y
+        if modified:
+            for a, v in modified.items():
+                setattr(widget, a, v)
+            widget.update(modified)
+
+    def submit(self, queue, seq, callback):
+        """
+        Add a batch of (func, args) calls for the clutter thread. The
+        batches are applied in the order they are submitted and the
+        callback is called in the clutter thread when the batch is
+        done. Executed in the kaa mainloop
+        """
+        self.lock.acquire()
+        try:
+            self.batches.append((queue, seq, callback))
+            if self.scheduled:
+                return
+            self.scheduled = True
+        finally:
+            self.lock.release()
+        # FIXME: idle_add does not work when animations are
+        # running. It seems to be that clutter uses as much CPU
+        # time as possible, nothing is idle.
+        gobject.timeout_add(0, self.sync)
+
+    def sync(self):
         """
         Sync the changes with the clutter objects
         Executed inside the clutter thread
         """
-        t0 = time.time()
-        freeze = False
+        while True:
+            self.lock.acquire()
+            try:
+                if not self.batches:
+                    self.scheduled = False
+                    return False
+                batch = queue, seq, callback = self.batches[0]
+            finally:
+                self.lock.release()
+            if self.ring and seq is not None and batch is not self.started:
+                # Records written before this sync must not overwrite
+                # its changes. Apply them first, the records written
+                # after it wait until it is done.
+                self.started = batch
+                self.drain_ring(seq - 1)
+            if not self.apply(queue):
+                # Not finished yet, but the scene is not frozen and we
+                # can go back to the clutter main loop to keep
+                # animations alive. Continue in the next frame.
+                gobject.timeout_add(scheduler.defer(len(queue)), self.sync)
+                return False
+            self.lock.acquire()
+            self.batches.pop(0)
+            self.lock.release()
+            if seq is not None:
+                self.sync_applied = seq
+            if self.ring:
+                self.drain_ring()
+            callback()
+
+    def apply(self, queue):
+        """
+        Call the functions in the queue. Returns False if the rest of
+        the queue has to wait for the next frame.
+        Executed inside the clutter thread
+        """
         while queue:
-            func, args = queue.pop(0)
-            if func == 'freeze':
+            if queue[0][0] == 'freeze':
                 # Freeze the scene. From now on it is not allowed to
                 # go back to the clutter main loop to keep animations
                 # alive or the user will see a half-finished scene.
-                freeze = True
-                continue
-            try:
-                func(*args)
-            except Exception, e:
-                log.exception('sync error: %s%s', func, args)
-            if not freeze and queue:
+                # Start in a new frame if it does not fit into this
+                # one to have all changes visible in the same frame.
+                if not scheduler.fits(len(queue) - 1):
+                    return False
+                queue.pop(0)
+                t0 = time.time()
+                calls = 0
+                while queue:
+                    func, args = queue.pop(0)
+                    if func == 'freeze':
+                        # merged syncs carry more than one marker
+                        continue
+                    self.call(func, args)
+                    calls += 1
                 sync_time = time.time() - t0
-                if sync_time > 0.01:
+                if calls:
+                    scheduler.account(calls, sync_time)
+                if sync_time > scheduler.interval:
                     # We should use the logging module somehow and get the
                     # logging info to the main process. Only print out the
-                    # sync time if we cannot make 100fps.
-                    log.warning('sync took %0.4f sec' % sync_time)
-                    # For further debug to detect what function /
-                    # widget is slow taht it took way too long:
-                    # print 'last call', func, args
-                if sync_time > 0.001:
-                    # Not finished yet, but the scene is not frozen
-                    # and we can go back to the clutter main loop to
-                    # keep animations alive.
-                    return True
-        sync_time = time.time() - t0
-        if sync_time > 0.01:
-            # We should use the logging module somehow and get the
-            # logging info to the main process. Only print out the
-            # sync time if we cannot make 100fps.
-            log.warning('kaa.candy warning: sync took %0.4f sec' % sync_time)
-        event.set()
-        return False
+                    # sync time if we drop frames.
+                    log.warning('kaa.candy warning: sync took %0.4f sec' % sync_time)
+                return True
+            if scheduler.calls and scheduler.remaining() <= 0:
+                return False
+            t0 = time.time()
+            self.call(*queue.pop(0))
+            scheduler.account(1, time.time() - t0)
+        return True
+
+    def call(self, func, args):
+        """
+        Call one function from the queue
+        Executed inside the clutter thread
+        """
+        try:
+            func(*args)
+        except Exception, e:
+            log.exception('sync error: %s%s', func, args)
 
 # global mainloop object
 mainloop = Mainloop()
@@ -148,6 +385,17 @@ class Server(object):
         self.ipc.register(self)
         self.widgets = {}
         self.initialized = False
+        self.sync_received = 0
+        # syncs waiting to be processed and syncs in the clutter thread
+        self.pending = []
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        # options from the application
+        self.config = {}
+        # callbacks returning statistics
+        self.stats_provider = {}
+        self.scheduler = scheduler
+        self.register_stats('scheduler', lambda: scheduler.stats.copy())
 
     def ipc_connected(self, client):
         """
@@ -167,19 +415,85 @@ class Server(object):
     def send_event(self, event, *args):
         self.ipc.rpc('event_%s' % event.replace('-', '_'), *args)
 
+    def register_stats(self, name, callback):
+        """
+        Register a callback returning a dict of statistics
+        """
+        self.stats_provider[name] = callback
+
+    @kaa.rpc.expose()
+    def stats(self):
+        """
+        Return the statistics of all registered providers
+        """
+        return dict([ (name, callback()) for name, callback in self.stats_provider.items() ])
+
     @kaa.rpc.expose()
-    def sync(self, tasks):
+    def sync(self, tasks, seq=None):
         """
-        Sync callback from the candy application
+        Sync callback from the candy application. If seq is given,
+        the call returns at once and the sync-done event is sent with
+        seq when the clutter thread applied the tasks. Without seq the
+        call blocks until then.
         """
+        self.sync_received += 1
         if not self.initialized:
             self.initialized = True
-            self.sync([
+            self.process([
                     ('import', ('candy', os.path.dirname(__file__) + '/widgets')),
                     ('import', ('player', os.path.dirname(__file__) + '/player')),
                     ('import', ('stage', os.path.dirname(__file__) + '/stage')),
-            ])
+            ], None).wait()
+        if seq is None:
+            self.process(tasks, self.sync_received).wait()
+            return
+        self.pending.append((tasks, seq))
+        self.process_pending()
+
+    def process_pending(self):
+        """
+        Process the waiting syncs in order. Stop at a sync changing a
+        widget a sync still in the clutter thread is using; it has to
+        wait for sync_done.
+        """
+        while self.pending:
+            tasks, seq = self.pending[0]
+            if self.conflicts(tasks):
+                return
+            self.pending.pop(0)
+            self.process(tasks, seq, True)
+
+    def conflicts(self, tasks):
+        """
+        Check if the tasks modify widgets used by syncs in the clutter
+        thread. The commands for update and position change the
+        backend widget in the kaa mainloop.
+        """
+        self.lock.acquire()
+        try:
+            if not self.in_flight:
+                return False
+            if None in self.in_flight.values():
+                # import in progress
+                return True
+            busy = set().union(*self.in_flight.values())
+        finally:
+            self.lock.release()
+        for cmd, args in tasks:
+            if cmd in ('update', 'position') and args[0] in busy:
+                return True
+        return False
+
+    def process(self, tasks, seq, ack=False):
+        """
+        Execute the tasks and pass the results to the clutter
+        thread. Returns a threading.Event set when the clutter thread
+        is done.
+        """
         queue = []
+        # widgets used by this sync or None if a later sync must wait
+        # for it to finish
+        touched = set()
         for cmd, args in tasks:
             if cmd == 'freeze':
                 # freeze meta-command after that the sync function in
@@ -197,18 +511,40 @@ class Server(object):
                     log.exception('sync error: %s%s', func, args)
             else:
                 log.error('unsupported command: %s', cmd)
-        if queue:
-            # sync with the clutter thread
-            event = threading.Event()
-            # FIXME: idle_add does not work when animations are
-            # running. It seems to be that clutter uses as much CPU
-            # time as possible, nothing is idle.
-            if kaa.get_thread_pool(kaa.GOBJECT) and kaa.get_thread_pool(kaa.GOBJECT).thread and \
-                    not kaa.get_thread_pool(kaa.GOBJECT).thread.is_alive():
-                log.error('gobject loop crashed')
-                sys.exit(1)
-            gobject.timeout_add(0, mainloop.sync, queue, event)
-            event.wait()
+            if cmd == 'import':
+                touched = None
+            elif touched is not None and cmd in ('add', 'call', 'position', 'update'):
+                touched.add(args[1] if cmd == 'add' else args[0])
+        if kaa.get_thread_pool(kaa.GOBJECT) and kaa.get_thread_pool(kaa.GOBJECT).thread and \
+                not kaa.get_thread_pool(kaa.GOBJECT).thread.is_alive():
+            log.error('gobject loop crashed')
+            sys.exit(1)
+        event = threading.Event()
+        self.lock.acquire()
+        self.in_flight[event] = touched
+        self.lock.release()
+        mainloop.submit(queue, seq, kaa.Callable(self.applied, event, seq, ack))
+        return event
+
+    def applied(self, event, seq, ack):
+        """
+        Callback when the clutter thread is done with a sync
+        Executed inside the clutter thread
+        """
+        self.lock.acquire()
+        del self.in_flight[event]
+        self.lock.release()
+        event.set()
+        if ack:
+            self.sync_done(seq)
+
+    @kaa.threaded(kaa.MAINTHREAD)
+    def sync_done(self, seq):
+        """
+        Acknowledge the sync and continue with the waiting ones
+        """
+        self.send_event('sync-done', seq)
+        self.process_pending()
 
     def cmd_import(self, name, path):
         """
@@ -216,6 +552,23 @@ class Server(object):
         """
         return mainloop.imp, (name, path, self)
 
+    def cmd_configure(self, options):
+        """
+        command for sync: set options from the application
+        """
+        self.config.update(options)
+        return scheduler.configure, (self.config,)
+
+    def cmd_ring(self, filename):
+        """
+        command for sync: use the ring buffer in filename for position
+        updates
+        """
+        ring = kaa.candy.ringbuffer.PositionRing(filename)
+        # both processes have the file mapped now
+        ring.unlink()
+        return mainloop.set_ring, (ring, self)
+
     def cmd_add(self, cls, wid):
         """
         command for sync: add a new widget based on cls with the given wid
@@ -41,6 +41,7 @@ class Stage(object):
         """
         self.obj = clutter.Stage.get_default()
         self.obj.hide_cursor()
+        self.server.scheduler.attach(self.obj)
         self.obj.connect('key-press-event', self.handle_key_press)
         self.obj.connect('key-release-event', self.handle_key_release)
         self.keysyms = {}
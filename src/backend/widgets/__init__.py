@@ -48,3 +48,17 @@ for name, module in kaa.utils.get_plugins(location=__file__).items():
         __all__.append(widget)
         globals()[widget] = getattr(module, widget)
 
+import decoder
+import cache
+import atlas
+import raster
+
+def init(server):
+    """
+    Initialize the widgets after the import
+    Executed inside the clutter thread
+    """
+    decoder.init(server)
+    cache.init(server)
+    atlas.init(server)
+    raster.init(server)
@@ -0,0 +1,342 @@
+# -*- coding: iso-8859-1 -*-
+# -----------------------------------------------------------------------------
+# atlas.py - shared textures for small images
+# -----------------------------------------------------------------------------
+# This file is imported by the backend process in the clutter
+# mainloop. Small images like icons are packed into a few large
+# textures. The image widgets show sub textures of these atlas
+# textures to avoid one GL texture per icon. The images are packed in
+# shelves: rows of images with a similar height. If the cogl version
+# does not support sub textures, the atlas is disabled and images get
+# their own texture. All functions must be called in the clutter
+# thread.
+#
+# -----------------------------------------------------------------------------
+# kaa-candy - Fourth generation Canvas System using Clutter as backend
+# Copyright (C) 2013 Dirk Meyer
+#
+# Based on various previous attempts to create a canvas system for
+# Freevo by Dirk Meyer and Jason Tackaberry.  Please see the file
+# AUTHORS for a complete list of authors.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MER-
+# CHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+# -----------------------------------------------------------------------------
+
+__all__ = []
+
+# python imports
+import logging
+import collections
+
+from gi.repository import Clutter as clutter
+
+try:
+    from gi.repository import Cogl
+except ImportError:
+    Cogl = None
+
+# get logging object
+log = logging.getLogger('candy')
+
+# empty pixels between two images to avoid bleeding on scaling
+GUTTER = 1
+
+class Shelf(object):
+    """
+    Row of images in an atlas texture
+    """
+    def __init__(self, y, height):
+        self.y = y
+        self.height = height
+        # first unused x position
+        self.x = 0
+        # (x, width) of released areas
+        self.free = []
+
+    def allocate(self, width, size):
+        """
+        Return the x position for an image or None if it does not fit
+        """
+        for pos, (x, free) in enumerate(self.free):
+            if free >= width:
+                if free > width:
+                    self.free[pos] = x + width, free - width
+                else:
+                    del self.free[pos]
+                return x
+        if self.x + width <= size:
+            self.x += width
+            return self.x - width
+        return None
+
+    def release(self, x, width):
+        """
+        Mark the area as unused
+        """
+        self.free.append((x, width))
+        self.free.sort()
+        # merge neighbouring areas
+        merged = []
+        for x, width in self.free:
+            if merged and merged[-1][0] + merged[-1][1] == x:
+                merged[-1] = merged[-1][0], merged[-1][1] + width
+            else:
+                merged.append((x, width))
+        if merged and merged[-1][0] + merged[-1][1] == self.x:
+            # the area at the end is unused again
+            self.x = merged.pop()[0]
+        self.free = merged
+
+    def empty(self):
+        """
+        Return True if no image is in the shelf
+        """
+        return self.x == 0
+
+
+class Atlas(object):
+    """
+    Texture with the images in shelves
+    """
+    def __init__(self, size):
+        self.size = size
+        self.shelves = []
+        # first y position not used by a shelf
+        self.top = 0
+        self.texture = Cogl.Texture.new_with_size(size, size, Cogl.TextureFlags.NO_ATLAS,
+            Cogl.PixelFormat.RGBA_8888_PRE)
+
+    def allocate(self, width, height):
+        """
+        Return (shelf, x) for the image or None if it does not fit
+        """
+        # try the shelves with the least wasted space first but do
+        # not waste more than half of a shelf. Empty shelves between
+        # other shelves can take any image that fits.
+        shelves = [ (s.height, s.y, s) for s in self.shelves if height <= s.height and \
+                        (s.height <= height * 2 or s.empty()) ]
+        for h, y, shelf in sorted(shelves):
+            x = shelf.allocate(width, self.size)
+            if x is not None:
+                return shelf, x
+        if self.top + height <= self.size:
+            shelf = Shelf(self.top, height)
+            self.shelves.append(shelf)
+            self.top += height
+            # the texture is not initialized; clear the shelf to keep
+            # random pixels out of the gutter of the shelf below
+            self.clear(0, shelf.y, self.size, height)
+            return shelf, shelf.allocate(width, self.size)
+        return None
+
+    def release(self, shelf, x, width):
+        """
+        Mark the area of the shelf as unused and remove empty shelves
+        at the end of the texture.
+        """
+        shelf.release(x, width)
+        while self.shelves and self.shelves[-1].empty():
+            self.top = self.shelves.pop().y
+
+    def clear(self, x, y, width, height):
+        """
+        Set the area to transparent pixels
+        """
+        self.texture.set_region(0, 0, x, y, width, height, width, height,
+            Cogl.PixelFormat.RGBA_8888_PRE, width * 4, '\0' * (width * height * 4))
+
+
+class Region(object):
+    """
+    Image in an atlas
+    """
+    def __init__(self, atlas, shelf, x, width, height, texture):
+        self.atlas = atlas
+        self.shelf = shelf
+        self.x = x
+        self.width = width
+        self.height = height
+        self.texture = texture
+        self.refcount = 1
+
+
+class AtlasCache(object):
+    """
+    Reference counted images in atlas textures
+    """
+    def __init__(self):
+        self.atlases = []
+        # regions by texture cache key, least recently used first
+        self.regions = collections.OrderedDict()
+        # False if the cogl version does not support sub textures
+        self.available = Cogl is not None
+        # options from the application, set by init()
+        self.config = {}
+        self.stats = { 'hits': 0, 'misses': 0, 'evicted': 0 }
+
+    def enabled(self, width, height):
+        """
+        Return True if an image of that size should be in the atlas
+        """
+        limit = self.config.get('atlas_image_size', 64)
+        return self.available and width <= limit and height <= limit
+
+    def get(self, key):
+        """
+        Return the sub texture for the key and add a reference to it
+        or None if the image is not in the atlas.
+        """
+        region = self.regions.get(key)
+        if region is None:
+            return None
+        self.stats['hits'] += 1
+        region.refcount += 1
+        # mark as recently used
+        del self.regions[key]
+        self.regions[key] = region
+        return region.texture
+
+    def add(self, key, pixbuf):
+        """
+        Copy the image into an atlas and return the sub texture. The
+        caller holds a reference to it. Returns None if the image does
+        not fit.
+        """
+        width, height = pixbuf.get_width(), pixbuf.get_height()
+        allocation = None
+        try:
+            allocation = self._allocate(width + GUTTER, height + GUTTER)
+            if allocation is None:
+                return None
+            atlas, shelf, x = allocation
+            # Clear the gutter and the shelf below the image. The area
+            # may contain an old image that would bleed into this one
+            # on scaling.
+            atlas.clear(x + width, shelf.y, GUTTER, shelf.height)
+            atlas.clear(x, shelf.y + height, width, shelf.height - height)
+            if pixbuf.get_has_alpha():
+                format = Cogl.PixelFormat.RGBA_8888
+            else:
+                format = Cogl.PixelFormat.RGB_888
+            atlas.texture.set_region(0, 0, x, shelf.y, width, height, width, height,
+                format, pixbuf.get_rowstride(), pixbuf.get_pixels())
+            texture = self._sub_texture(atlas.texture, x, shelf.y, width, height)
+        except Exception, e:
+            log.error('atlas disabled: %s', e)
+            self.available = False
+            if allocation:
+                atlas.release(shelf, x, width + GUTTER)
+            return None
+        self.stats['misses'] += 1
+        self.regions[key] = Region(atlas, shelf, x, width, height, texture)
+        return texture
+
+    def release(self, key):
+        """
+        Drop a reference. Unused images stay in the atlas until the
+        space is needed.
+        """
+        region = self.regions.get(key)
+        if region is not None:
+            region.refcount -= 1
+
+    def _sub_texture(self, texture, x, y, width, height):
+        """
+        Create a texture for the area of the atlas texture
+        """
+        if hasattr(Cogl, 'SubTexture'):
+            context = clutter.get_default_backend().get_cogl_context()
+            return Cogl.SubTexture.new(context, texture, x, y, width, height)
+        return Cogl.Texture.new_from_sub_texture(texture, x, y, width, height)
+
+    def _allocate(self, width, height):
+        """
+        Return (atlas, shelf, x) for an image or None
+        """
+        size = self.config.get('atlas_size', 1024)
+        if width > size or height > size:
+            return None
+        for atlas in self.atlases:
+            allocation = atlas.allocate(width, height)
+            if allocation:
+                return (atlas,) + allocation
+        # free unused images in shelves that can hold the image
+        for key, region in self.regions.items():
+            if region.refcount or region.shelf.height < height:
+                continue
+            del self.regions[key]
+            region.atlas.release(region.shelf, region.x, region.width + GUTTER)
+            self.stats['evicted'] += 1
+            allocation = region.atlas.allocate(width, height)
+            if allocation:
+                return (region.atlas,) + allocation
+        # free shelves at the end of an atlas with only unused images
+        # to make room for a higher shelf
+        for atlas in self.atlases:
+            regions = [ (key, r) for key, r in self.regions.items() if r.atlas is atlas ]
+            for shelf in reversed(atlas.shelves):
+                if [ r for key, r in regions if r.shelf is shelf and r.refcount ]:
+                    break
+                if shelf.y + height <= atlas.size:
+                    for key, region in regions:
+                        if region.shelf.y >= shelf.y:
+                            del self.regions[key]
+                            atlas.release(region.shelf, region.x, region.width + GUTTER)
+                            self.stats['evicted'] += 1
+                    return (atlas,) + atlas.allocate(width, height)
+        if len(self.atlases) >= self.config.get('atlas_count', 4):
+            return None
+        try:
+            atlas = Atlas(size)
+        except Exception, e:
+            log.error('atlas disabled: %s', e)
+            self.available = False
+            return None
+        self.atlases.append(atlas)
+        return (atlas,) + atlas.allocate(width, height)
+
+    def get_stats(self):
+        """
+        Return the occupancy of the atlas textures. Fragmentation is
+        the part of the area used by shelves not covered by images.
+        """
+        stats = self.stats.copy()
+        total = used = unused = allocated = 0
+        for atlas in self.atlases:
+            total += atlas.size * atlas.size
+            allocated += sum([ shelf.height * atlas.size for shelf in atlas.shelves ])
+        for region in self.regions.values():
+            area = (region.width + GUTTER) * (region.height + GUTTER)
+            if region.refcount:
+                used += area
+            else:
+                unused += area
+        stats['atlases'] = len(self.atlases)
+        stats['images'] = len(self.regions)
+        stats['occupancy'] = float(used) / total if total else 0.0
+        stats['unused'] = float(unused) / total if total else 0.0
+        stats['fragmentation'] = 1 - float(used + unused) / allocated if allocated else 0.0
+        return stats
+
+# global atlas
+atlas = AtlasCache()
+
+def init(server):
+    """
+    Connect the atlas to the server
+    """
+    atlas.config = server.config
+    server.register_stats('atlas', atlas.get_stats)
@@ -0,0 +1,193 @@
+# -*- coding: iso-8859-1 -*-
+# -----------------------------------------------------------------------------
+# cache.py - texture cache shared by all image widgets
+# -----------------------------------------------------------------------------
+# This file is imported by the backend process in the clutter
+# mainloop. Textures loaded from files are stored by filename,
+# modification time and decoding size. Widgets showing the same image
+# share the cogl texture. Textures no longer used by any widget stay
+# in the cache until the memory budget is exceeded. All functions
+# must be called in the clutter thread.
+#
+# -----------------------------------------------------------------------------
+# kaa-candy - Fourth generation Canvas System using Clutter as backend
+# Copyright (C) 2013 Dirk Meyer
+#
+# Based on various previous attempts to create a canvas system for
+# Freevo by Dirk Meyer and Jason Tackaberry.  Please see the file
+# AUTHORS for a complete list of authors.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MER-
+# CHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+# -----------------------------------------------------------------------------
+
+__all__ = []
+
+# python imports
+import os
+import collections
+
+class Entry(object):
+    """
+    Texture in the cache. The texture is None while the first widget
+    using it is still loading the image.
+    """
+    def __init__(self, loader):
+        self.texture = None
+        self.size = 0
+        self.refcount = 1
+        self.loader = loader
+        self.waiting = []
+
+
+class TextureCache(object):
+    """
+    Reference counted textures with LRU eviction
+    """
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+        # bytes used by all loaded textures
+        self.size = 0
+        # bytes used by loaded textures no widget uses
+        self.unused = 0
+        # options from the application, set by init()
+        self.config = {}
+        self.stats = { 'hits': 0, 'misses': 0, 'evicted': 0 }
+
+    def key(self, filename, size):
+        """
+        Return the key for the file decoded at the given size or None
+        if the file does not exist.
+        """
+        try:
+            return filename, os.stat(filename).st_mtime, size
+        except OSError:
+            return None
+
+    def get(self, key):
+        """
+        Return the texture for the key and add a reference to it. If
+        the texture is not loaded, None is returned and no reference
+        is added.
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry.texture is None:
+            return None
+        self.stats['hits'] += 1
+        if not entry.refcount:
+            self.unused -= entry.size
+        entry.refcount += 1
+        # mark as recently used
+        del self.entries[key]
+        self.entries[key] = entry
+        return entry.texture
+
+    def join(self, key, callback):
+        """
+        Add a reference to a texture not loaded yet. If another widget
+        is loading it, the callback is called with the texture later
+        and True is returned. Otherwise the caller has to load the
+        texture and call add() or release() and False is returned. If
+        the other widget fails, the callback is called with None and
+        the reference is dropped.
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.stats['hits'] += 1
+            if not entry.refcount:
+                self.unused -= entry.size
+            entry.refcount += 1
+            entry.waiting.append(callback)
+            return True
+        self.stats['misses'] += 1
+        self.entries[key] = Entry(callback)
+        return False
+
+    def add(self, key, texture, size):
+        """
+        Set the texture loaded by the widget called join() first
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry.texture is not None:
+            return
+        entry.texture = texture
+        entry.size = size
+        self.size += size
+        if not entry.refcount:
+            self.unused += size
+        waiting, entry.waiting = entry.waiting, []
+        for callback in waiting:
+            callback(texture)
+        self.evict()
+
+    def release(self, key, callback):
+        """
+        Drop a reference. The callback must be the one passed to join
+        if the widget called it.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        entry.refcount -= 1
+        if entry.texture is not None:
+            if not entry.refcount:
+                self.unused += entry.size
+                self.evict()
+            return
+        if callback in entry.waiting:
+            entry.waiting.remove(callback)
+        elif callback == entry.loader:
+            # The loading widget gave up. The waiting widgets have to
+            # load the texture themselves.
+            del self.entries[key]
+            for callback in entry.waiting:
+                callback(None)
+
+    def evict(self):
+        """
+        Remove unused textures until they fit into the budget.
+        Textures used by widgets do not count.
+        """
+        budget = self.config.get('texture_cache', 64) * 1024 * 1024
+        for key, entry in self.entries.items():
+            if self.unused <= budget:
+                break
+            if not entry.refcount and entry.texture is not None:
+                del self.entries[key]
+                self.size -= entry.size
+                self.unused -= entry.size
+                self.stats['evicted'] += 1
+
+    def get_stats(self):
+        """
+        Return the statistics of the cache
+        """
+        stats = self.stats.copy()
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = float(stats['hits']) / lookups if lookups else 0.0
+        stats['entries'] = len(self.entries)
+        stats['resident_bytes'] = self.size
+        stats['unused_bytes'] = self.unused
+        return stats
+
+# global texture cache
+textures = TextureCache()
+
+def init(server):
+    """
+    Connect the cache to the server
+    """
+    textures.config = server.config
+    server.register_stats('textures', textures.get_stats)
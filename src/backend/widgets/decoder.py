@@ -0,0 +1,319 @@
+# -*- coding: iso-8859-1 -*-
+# -----------------------------------------------------------------------------
+# decoder.py - image decoding outside the clutter thread
+# -----------------------------------------------------------------------------
+# This file is imported by the backend process in the clutter
+# mainloop. Images are decoded by a pool of worker threads using
+# GdkPixbuf. The clutter thread only uploads the decoded pixels to
+# the texture. Jobs are ordered by priority: previews of progressive
+# images first, then images of widgets visible on the stage and the
+# rest at the end. If the queue is full or
+# GdkPixbuf is not available, the widget has to load the image itself.
+#
+# -----------------------------------------------------------------------------
+# kaa-candy - Fourth generation Canvas System using Clutter as backend
+# Copyright (C) 2013 Dirk Meyer
+#
+# Based on various previous attempts to create a canvas system for
+# Freevo by Dirk Meyer and Jason Tackaberry.  Please see the file
+# AUTHORS for a complete list of authors.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MER-
+# CHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+# -----------------------------------------------------------------------------
+
+__all__ = []
+
+# python imports
+import os
+import time
+import struct
+import heapq
+import logging
+import threading
+
+from gi.repository import GObject as gobject
+
+try:
+    from gi.repository import GdkPixbuf
+except ImportError:
+    GdkPixbuf = None
+
+# get logging object
+log = logging.getLogger('candy')
+
+# job priorities, lower values first
+PRIORITY_PREVIEW = -1
+PRIORITY_VISIBLE = 0
+PRIORITY_HIDDEN = 1
+
+def exif_thumbnail(filename):
+    """
+    Return the thumbnail embedded in the EXIF data of a JPEG file or
+    None if the file has none.
+    """
+    fd = open(filename, 'rb')
+    try:
+        if fd.read(2) != '\xff\xd8':
+            return None
+        while True:
+            header = fd.read(4)
+            if len(header) < 4 or header[0] != '\xff':
+                return None
+            segtype, seglen = ord(header[1]), struct.unpack('>H', header[2:])[0]
+            if segtype == 0xe1:
+                data = fd.read(seglen - 2)
+                if data[:6] == 'Exif\0\0':
+                    return _exif_thumbnail(data[6:])
+            elif segtype >= 0xc0 and segtype <= 0xcf or segtype in (0xd9, 0xda):
+                # EXIF data must be before the image data
+                return None
+            else:
+                fd.seek(seglen - 2, 1)
+    except struct.error:
+        return None
+    finally:
+        fd.close()
+
+def _exif_thumbnail(tiff):
+    """
+    Return the JPEG thumbnail from the second IFD of the TIFF
+    structure in the EXIF segment
+    """
+    endian = { 'II': '<', 'MM': '>' }.get(tiff[:2])
+    if not endian:
+        return None
+    # skip the first IFD with the image information
+    offset = struct.unpack(endian + 'I', tiff[4:8])[0]
+    count = struct.unpack(endian + 'H', tiff[offset:offset+2])[0]
+    offset = struct.unpack(endian + 'I', tiff[offset+2+count*12:offset+6+count*12])[0]
+    if not offset:
+        return None
+    count = struct.unpack(endian + 'H', tiff[offset:offset+2])[0]
+    start = length = None
+    for pos in range(offset + 2, offset + 2 + count * 12, 12):
+        tag, type, num, value = struct.unpack(endian + 'HHII', tiff[pos:pos+12])
+        if tag == 0x201:
+            start = value
+        elif tag == 0x202:
+            length = value
+    if not start or not length or start + length > len(tiff):
+        return None
+    return tiff[start:start+length]
+
+class DecodeJob(object):
+    """
+    Image waiting for a worker thread
+    """
+    def __init__(self, filename, delete, size, priority, callback, preview):
+        self.filename = filename
+        self.delete = delete
+        self.size = size
+        self.priority = priority
+        self.callback = callback
+        self.preview = preview
+        self.cancelled = False
+        self.pixbuf = None
+
+    def cancel(self):
+        """
+        Drop the job. The callback will not be called.
+        """
+        self.cancelled = True
+
+
+class ImageDecoder(object):
+    """
+    Pool of worker threads decoding images
+    """
+    def __init__(self):
+        self.queue = []
+        self.condition = threading.Condition()
+        self.threads = []
+        # options from the application, set by init()
+        self.config = {}
+        # counter to keep the order of jobs with the same priority
+        self.counter = 0
+        self.stats = {
+            'decoded': 0, 'decode_time': 0.0, 'uploaded': 0, 'upload_time': 0.0,
+            'cancelled': 0, 'failed': 0, 'fallback': 0, 'queued': 0, 'previews': 0 }
+
+    @property
+    def available(self):
+        """
+        True if images can be decoded in the worker threads
+        """
+        return GdkPixbuf is not None
+
+    def submit(self, filename, delete, size, priority, callback, preview=False):
+        """
+        Add an image to the queue. The callback is called with the
+        GdkPixbuf or None on errors in the clutter thread. Returns the
+        job or None if the queue is full and the image must be loaded
+        synchronously. If preview is True, a small version of the
+        image is decoded using decode_preview.
+        """
+        self.condition.acquire()
+        try:
+            if len(self.queue) >= self.config.get('decoder_queue', 64):
+                self.stats['fallback'] += 1
+                return None
+            if not self.threads:
+                for i in range(self.config.get('decoder_threads', 2)):
+                    thread = threading.Thread(target=self._worker, name='candy-decoder-%s' % i)
+                    thread.daemon = True
+                    thread.start()
+                    self.threads.append(thread)
+            job = DecodeJob(filename, delete, size, priority, callback, preview)
+            self.counter += 1
+            heapq.heappush(self.queue, (priority, self.counter, job))
+            self.stats['queued'] = len(self.queue)
+            self.condition.notify()
+            return job
+        finally:
+            self.condition.release()
+
+    def set_priority(self, job, priority):
+        """
+        Change the priority of a job still in the queue
+        """
+        self.condition.acquire()
+        try:
+            if job.priority == priority:
+                return
+            for pos, (p, counter, queued) in enumerate(self.queue):
+                if queued is job:
+                    job.priority = priority
+                    self.queue[pos] = priority, counter, job
+                    heapq.heapify(self.queue)
+                    return
+        finally:
+            self.condition.release()
+
+    def decode(self, filename, size=None):
+        """
+        Decode the image, scaled to size if given. The JPEG loader
+        uses DCT scaling for this and does not decode the full image.
+        """
+        if size:
+            return GdkPixbuf.Pixbuf.new_from_file_at_scale(filename, size[0], size[1], False)
+        return GdkPixbuf.Pixbuf.new_from_file(filename)
+
+    def decode_preview(self, filename, size=None):
+        """
+        Decode a small version of a JPEG image: the EXIF thumbnail if
+        the file has one or the image at 1/8 of the size. Returns None
+        for other formats.
+        """
+        data = exif_thumbnail(filename)
+        if data:
+            loader = GdkPixbuf.PixbufLoader()
+            loader.write(data)
+            loader.close()
+            return loader.get_pixbuf()
+        if open(filename, 'rb').read(2) != '\xff\xd8':
+            return None
+        if size is None:
+            size = GdkPixbuf.Pixbuf.get_file_info(filename)[1:]
+        # the JPEG loader decodes 1/8 of the size without the inverse
+        # DCT of most coefficients
+        width, height = max(1, size[0] / 8), max(1, size[1] / 8)
+        return GdkPixbuf.Pixbuf.new_from_file_at_scale(filename, width, height, False)
+
+    def get_stats(self):
+        """
+        Return the statistics with average times in ms
+        """
+        self.condition.acquire()
+        stats = self.stats.copy()
+        self.condition.release()
+        if stats['decoded']:
+            stats['decode_time'] = stats['decode_time'] * 1000 / stats['decoded']
+        if stats['uploaded']:
+            stats['upload_time'] = stats['upload_time'] * 1000 / stats['uploaded']
+        return stats
+
+    def _worker(self):
+        """
+        Decode images from the queue
+        Executed in the worker threads
+        """
+        while True:
+            self.condition.acquire()
+            try:
+                while not self.queue:
+                    self.condition.wait()
+                job = heapq.heappop(self.queue)[2]
+                self.stats['queued'] = len(self.queue)
+            finally:
+                self.condition.release()
+            if not job.cancelled:
+                t0 = time.time()
+                try:
+                    if job.preview:
+                        job.pixbuf = self.decode_preview(job.filename, job.size)
+                        self.condition.acquire()
+                        self.stats['previews'] += 1
+                        self.condition.release()
+                    else:
+                        job.pixbuf = self.decode(job.filename, job.size)
+                        self.condition.acquire()
+                        self.stats['decoded'] += 1
+                        self.stats['decode_time'] += time.time() - t0
+                        self.condition.release()
+                except Exception, e:
+                    log.error('unable to decode %s: %s', job.filename, e)
+                    self.condition.acquire()
+                    self.stats['failed'] += 1
+                    self.condition.release()
+            if job.delete and os.path.exists(job.filename):
+                os.unlink(job.filename)
+            if job.cancelled:
+                self.condition.acquire()
+                self.stats['cancelled'] += 1
+                self.condition.release()
+                continue
+            gobject.timeout_add(0, self._upload, job)
+
+    def _upload(self, job):
+        """
+        Pass the decoded image to the widget
+        Executed in the clutter thread
+        """
+        if job.cancelled:
+            self.condition.acquire()
+            self.stats['cancelled'] += 1
+            self.condition.release()
+            return False
+        t0 = time.time()
+        try:
+            job.callback(job.pixbuf)
+        except Exception, e:
+            log.exception('unable to upload %s', job.filename)
+        if job.pixbuf is not None:
+            self.stats['uploaded'] += 1
+            self.stats['upload_time'] += time.time() - t0
+        job.pixbuf = None
+        return False
+
+# global decoder object
+decoder = ImageDecoder()
+
+def init(server):
+    """
+    Connect the decoder to the server
+    """
+    decoder.config = server.config
+    server.register_stats('decoder', decoder.get_stats)
@@ -32,11 +32,19 @@
 __all__ = [ 'CairoTexture', 'ImageTexture' ]
 
 import os
+import mmap
+import logging
 
 import cairo
 from gi.repository import Clutter as clutter
 
 import widget
+from decoder import decoder, PRIORITY_PREVIEW, PRIORITY_VISIBLE, PRIORITY_HIDDEN
+from cache import textures
+from atlas import atlas
+
+# get logging object
+log = logging.getLogger('candy')
 
 class CairoTexture(widget.Widget):
     """
@@ -91,7 +99,7 @@ class CairoTexture(widget.Widget):
         super(CairoTexture, self).update(modified)
         if ('width' in modified or 'height' in modified) and self.height and self.width:
             self.content.set_size(self.width, self.height)
-        for attribute in 'opacity', 'scale_x', 'scale_y', 'anchor_point':
+        for attribute in 'opacity', 'scale_x', 'scale_y', 'anchor_point', 'visible', 'xalign', 'yalign':
             if attribute in modified:
                 modified.pop(attribute)
         if modified:
@@ -103,6 +111,23 @@ class ImageTexture(widget.Widget):
     Image widget.
     """
 
+    # image waiting for the decoder
+    job = None
+    # preview waiting for the decoder and True while it is shown
+    preview_job = None
+    preview = False
+    # copy of the preview fading out above the image
+    fade = None
+    # size to decode the image at
+    image_size = None
+    # key of the texture in the cache
+    cache_key = None
+    # key of the image in the atlas
+    atlas_key = None
+    # priority of the widget in the application; PRIORITY_LOW for
+    # widgets not visible yet
+    priority = 0
+
     def create(self):
         """
         Create the clutter object
@@ -115,15 +140,219 @@ class ImageTexture(widget.Widget):
         Render the widget
         """
         super(ImageTexture, self).update(modified)
-        if 'sync_data' in modified and self.sync_data:
-            filename, delete = self.sync_data
-            # TODO: the prepare function should always load the cogl
-            # texture in the main thread to avoid blocking the clutter
-            # thread. Loading the image here using kaa.imlib2 and
-            # putting the raw data on the texture is actually slower
-            # sometimes.
-            if self.load_async:
-                self.obj.set_load_async(True)
-            self.obj.set_from_file(filename)
-            if delete:
-                os.unlink(filename)
+        if 'priority' in modified and self.job:
+            decoder.set_priority(self.job, self.decode_priority())
+        if not 'sync_data' in modified and not 'image_size' in modified:
+            return
+        # a new image or size replaces the current one
+        self.release()
+        if not self.sync_data:
+            return
+        filename, delete = self.sync_data[:2]
+        if not 'sync_data' in modified and delete:
+            # the file is already deleted
+            return
+        if len(self.sync_data) > 2:
+            # raw BGRA data from kaa.imlib2
+            return self.upload_raw(filename, *self.sync_data[2])
+        self.load(filename, delete)
+
+    def load(self, filename, delete):
+        """
+        Load the image from the cache or the file
+        """
+        if not delete and (decoder.available or not self.load_async):
+            # files not created for this widget can be shared
+            self.cache_key = textures.key(filename, self.image_size)
+        if self.cache_key:
+            texture = atlas.get(self.cache_key)
+            if texture is not None:
+                # small image already in the atlas
+                self.atlas_key, self.cache_key = self.cache_key, None
+                self.obj.set_cogl_texture(texture)
+                return
+            texture = textures.get(self.cache_key)
+            if texture is not None:
+                self.obj.set_cogl_texture(texture)
+                return
+            if textures.join(self.cache_key, self.set_texture):
+                # another widget is loading the image
+                return
+        if decoder.available:
+            # decode in the worker threads
+            priority = self.decode_priority()
+            if self.progressive and not delete:
+                # show a small version of the image first
+                self.preview_job = decoder.submit(filename, False, self.image_size,
+                    PRIORITY_PREVIEW, self.upload_preview, preview=True)
+            self.job = decoder.submit(filename, delete, self.image_size, priority, self.upload)
+            if not self.job:
+                # queue full, decode in the clutter thread
+                try:
+                    pixbuf = decoder.decode(filename, self.image_size)
+                except Exception, e:
+                    log.error('unable to decode %s: %s', filename, e)
+                    pixbuf = None
+                if delete:
+                    os.unlink(filename)
+                self.upload(pixbuf)
+            return
+        # no decoder, load the image in the clutter thread
+        if self.load_async:
+            self.obj.set_load_async(True)
+        self.obj.set_from_file(filename)
+        if delete:
+            os.unlink(filename)
+        if self.cache_key:
+            self.add_texture()
+
+    def decode_priority(self):
+        """
+        Return the priority for the decoder. The application knows
+        which widgets are visible; new widgets are not mapped on the
+        stage before the next sync.
+        """
+        if self.priority:
+            return PRIORITY_HIDDEN
+        return PRIORITY_VISIBLE
+
+    def upload_preview(self, pixbuf):
+        """
+        Show the preview until the image is decoded
+        Executed in the clutter thread
+        """
+        self.preview_job = None
+        if pixbuf is None or self.obj is None or self.job is None:
+            # no preview or the image is already there
+            return
+        has_alpha = pixbuf.get_has_alpha()
+        self.obj.set_from_rgb_data(pixbuf.get_pixels(), has_alpha, pixbuf.get_width(),
+            pixbuf.get_height(), pixbuf.get_rowstride(), 4 if has_alpha else 3,
+            clutter.TextureFlags.NONE)
+        self.preview = True
+
+    def fade_preview(self):
+        """
+        Fade out the preview above the image. A ClutterTexture does
+        not paint children, the copy is added to the parent with the
+        same geometry.
+        """
+        parent = self.obj.get_parent()
+        if parent is None:
+            return
+        fade = clutter.Texture.new()
+        fade.set_cogl_texture(self.obj.get_cogl_texture())
+        fade.set_position(*self.obj.get_position())
+        fade.set_size(*self.obj.get_size())
+        fade.set_scale(*self.obj.get_scale())
+        fade.set_anchor_point(*self.obj.get_anchor_point())
+        fade.set_opacity(self.obj.get_opacity())
+        parent.insert_child_above(fade, self.obj)
+        fade.show()
+        self.fade = fade
+        animation = fade.animatev(clutter.AnimationMode.LINEAR, int(self.crossfade * 1000) or 1,
+            [ 'opacity' ], [ 0 ])
+        animation.connect('completed', self._fade_completed, fade)
+
+    def _fade_completed(self, animation, fade):
+        """
+        Remove the preview when the animation is done
+        """
+        if self.fade is fade:
+            self.fade = None
+            fade.destroy()
+
+    def upload(self, pixbuf):
+        """
+        Set the decoded image
+        Executed in the clutter thread
+        """
+        self.job = None
+        if pixbuf is None:
+            # decoding failed, let other widgets waiting for the
+            # texture try it themselves
+            return self.release()
+        if self.obj is None:
+            return
+        if self.preview and self.crossfade:
+            self.fade_preview()
+        self.preview = False
+        if self.cache_key and atlas.enabled(pixbuf.get_width(), pixbuf.get_height()):
+            texture = atlas.add(self.cache_key, pixbuf)
+            if texture is not None:
+                # The atlas shares the image between the widgets. Other
+                # widgets waiting in the texture cache find it there
+                # when the entry is dropped.
+                key = self.cache_key
+                textures.release(key, self.set_texture)
+                self.atlas_key, self.cache_key = key, None
+                self.obj.set_cogl_texture(texture)
+                return
+        has_alpha = pixbuf.get_has_alpha()
+        self.obj.set_from_rgb_data(pixbuf.get_pixels(), has_alpha, pixbuf.get_width(),
+            pixbuf.get_height(), pixbuf.get_rowstride(), 4 if has_alpha else 3,
+            clutter.TextureFlags.NONE)
+        if self.cache_key:
+            self.add_texture()
+
+    def add_texture(self):
+        """
+        Add the loaded texture to the cache
+        """
+        width, height = self.obj.get_base_size()
+        textures.add(self.cache_key, self.obj.get_cogl_texture(), width * height * 4)
+
+    def set_texture(self, texture):
+        """
+        Callback from the cache when another widget loaded the image
+        """
+        if texture is None:
+            # the other widget failed, load it here
+            self.cache_key = None
+            filename, delete = self.sync_data[:2]
+            return self.load(filename, delete)
+        self.obj.set_cogl_texture(texture)
+
+    def release(self):
+        """
+        Stop loading the image and release the texture
+        """
+        if self.job:
+            self.job.cancel()
+            self.job = None
+        if self.preview_job:
+            self.preview_job.cancel()
+            self.preview_job = None
+        self.preview = False
+        if self.fade:
+            self.fade.destroy()
+            self.fade = None
+        if self.cache_key:
+            textures.release(self.cache_key, self.set_texture)
+            self.cache_key = None
+        if self.atlas_key:
+            atlas.release(self.atlas_key)
+            self.atlas_key = None
+
+    def upload_raw(self, filename, width, height, stride):
+        """
+        Set the image from the raw BGRA data in the file
+        """
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            data = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+            os.unlink(filename)
+        try:
+            self.obj.set_from_rgb_data(data[:], True, width, height, stride, 4,
+                clutter.TextureFlags.RGB_FLAG_BGR)
+        finally:
+            data.close()
+
+    def delete(self):
+        """
+        Delete the clutter object
+        """
+        self.release()
+        super(ImageTexture, self).delete()
@@ -35,29 +35,31 @@ __all__ = [ 'Label' ]
 import cairo
 
 # kaa.candy imports
-import image
-import core
+import raster
 
-class Label(image.CairoTexture):
+class Label(raster.RasterTexture):
 
-    def draw(self, cr):
+    def get_params(self):
         """
-        Render the cairo context
+        Return the arguments for render
         """
-        fade = self.font.get_width(self.text) > self.width
-        # draw new text string
-        if self.color:
-            cr.set_source_rgba(*self.color.to_cairo())
-        cr.select_font_face(self.font.name, cairo.FONT_SLANT_NORMAL)
-        cr.set_font_size(self.font.size)
-        if fade and self.color:
-            s = cairo.LinearGradient(0, 0, self.width, 0)
-            c = self.color.to_cairo()
-            s.add_color_stop_rgba(0, *c)
+        color = self.color and tuple(self.color.to_cairo())
+        return self.text, self.font.name, self.font.size, color, self.width
+
+    @staticmethod
+    def render(cr, text, font, size, color, width):
+        """
+        Render the cairo context from the cached glyphs
+        """
+        glyphs, extent = raster.glyphs.layout(font, size, text, width)
+        if color:
+            cr.set_source_rgba(*color)
+        if color and extent > width:
+            s = cairo.LinearGradient(0, 0, width, 0)
+            s.add_color_stop_rgba(0, *color)
             # 50 pixel fading
-            s.add_color_stop_rgba(1 - (50.0 / self.width), *c)
-            s.add_color_stop_rgba(1, c[0], c[1], c[2], 0)
+            s.add_color_stop_rgba(1 - (50.0 / width), *color)
+            s.add_color_stop_rgba(1, color[0], color[1], color[2], 0)
             cr.set_source(s)
-        cr.move_to(0, cr.font_extents()[0])
-        cr.show_text(self.text)
-        return True
+        for mask, x, y in glyphs:
+            cr.mask_surface(mask, x, y)
@@ -0,0 +1,471 @@
+# -*- coding: iso-8859-1 -*-
+# -----------------------------------------------------------------------------
+# raster.py - text rendering outside the clutter thread
+# -----------------------------------------------------------------------------
+# This file is imported by the backend process in the clutter
+# mainloop. Label and Text widgets render their text with cairo in a
+# worker thread into an image buffer. The clutter thread only uploads
+# the finished buffer. The rendered buffers are kept in a cache by
+# text, font, color and size. Widgets showing the same text share one
+# rendering. If config.text_threads is 0 or the clutter version has no
+# ClutterImage, the text is rendered in the clutter thread on paint.
+# Labels are composed from a cache of glyph masks: each glyph of a
+# font is rendered once and later only painted with the label color.
+#
+# -----------------------------------------------------------------------------
+# kaa-candy - Fourth generation Canvas System using Clutter as backend
+# Copyright (C) 2013 Dirk Meyer
+#
+# Based on various previous attempts to create a canvas system for
+# Freevo by Dirk Meyer and Jason Tackaberry.  Please see the file
+# AUTHORS for a complete list of authors.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MER-
+# CHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+# -----------------------------------------------------------------------------
+
+__all__ = []
+
+# python imports
+import sys
+import math
+import time
+import logging
+import threading
+import collections
+
+import cairo
+from gi.repository import Clutter as clutter
+from gi.repository import GObject as gobject
+
+try:
+    from gi.repository import Cogl
+except ImportError:
+    Cogl = None
+
+# kaa.candy imports
+import widget
+import image
+
+# get logging object
+log = logging.getLogger('candy')
+
+# cairo stores ARGB32 as native endian 32 bit values
+if Cogl is not None:
+    if sys.byteorder == 'little':
+        PIXEL_FORMAT = Cogl.PixelFormat.BGRA_8888_PRE
+    else:
+        PIXEL_FORMAT = Cogl.PixelFormat.ARGB_8888_PRE
+
+class RasterJob(object):
+    """
+    Text waiting for a worker thread
+    """
+    def __init__(self, key, render, params, size):
+        self.key = key
+        self.render = render
+        self.params = params
+        self.size = size
+        # widgets waiting for the result
+        self.callbacks = []
+        # True when a worker thread took the job from the queue
+        self.taken = False
+        self.result = None
+
+    def cancel(self, callback):
+        """
+        Remove the callback. The job is dropped if nobody is waiting
+        for the result anymore.
+        """
+        if callback in self.callbacks:
+            self.callbacks.remove(callback)
+
+    @property
+    def cancelled(self):
+        """
+        True if nobody is waiting for the result
+        """
+        return not self.callbacks
+
+
+class Rasterizer(object):
+    """
+    Pool of worker threads rendering text and the cache of the results
+    """
+    def __init__(self):
+        self.queue = collections.deque()
+        # jobs waiting or rendering by key; only jobs still in the queue
+        # take more callbacks
+        self.jobs = {}
+        self.condition = threading.Condition()
+        self.threads = []
+        # rendered buffers by key, least recently used first
+        self.cache = collections.OrderedDict()
+        self.cache_size = 0
+        # options from the application, set by init()
+        self.config = {}
+        self.stats = {
+            'rendered': 0, 'render_time': 0.0, 'uploaded': 0, 'upload_time': 0.0,
+            'painted': 0, 'paint_time': 0.0, 'hits': 0, 'cancelled': 0, 'failed': 0 }
+
+    @property
+    def available(self):
+        """
+        True if text can be rendered in the worker threads
+        """
+        return Cogl is not None and hasattr(clutter, 'Image') and \
+            self.config.get('text_threads', 1) > 0
+
+    def get(self, key):
+        """
+        Return the cached result for the key or None
+        """
+        result = self.cache.pop(key, None)
+        if result is not None:
+            self.stats['hits'] += 1
+            self.cache[key] = result
+        return result
+
+    def submit(self, key, render, params, size, callback):
+        """
+        Add a text to the queue. The render function is called with a
+        cairo context of the given size and the params in a worker
+        thread. The callback is called with (data, width, height,
+        stride) or None on errors in the clutter thread. Widgets
+        submitting the same key share the job until a worker thread
+        takes it from the queue.
+        """
+        self.condition.acquire()
+        try:
+            job = self.jobs.get(key)
+            if job is not None and not job.taken:
+                job.callbacks.append(callback)
+                return job
+            if not self.threads:
+                for i in range(self.config.get('text_threads', 1)):
+                    thread = threading.Thread(target=self._worker, name='candy-raster-%s' % i)
+                    thread.daemon = True
+                    thread.start()
+                    self.threads.append(thread)
+            job = RasterJob(key, render, params, size)
+            job.callbacks.append(callback)
+            self.jobs[key] = job
+            self.queue.append(job)
+            self.condition.notify()
+            return job
+        finally:
+            self.condition.release()
+
+    def get_stats(self):
+        """
+        Return the statistics with average times in ms
+        """
+        self.condition.acquire()
+        stats = self.stats.copy()
+        self.condition.release()
+        if stats['rendered']:
+            stats['render_time'] = stats['render_time'] * 1000 / stats['rendered']
+        if stats['uploaded']:
+            stats['upload_time'] = stats['upload_time'] * 1000 / stats['uploaded']
+        if stats['painted']:
+            stats['paint_time'] = stats['paint_time'] * 1000 / stats['painted']
+        stats['cached'] = len(self.cache)
+        stats['cache_bytes'] = self.cache_size
+        return stats
+
+    def _worker(self):
+        """
+        Render the text from the queue
+        Executed in the worker threads
+        """
+        while True:
+            self.condition.acquire()
+            try:
+                while not self.queue:
+                    self.condition.wait()
+                job = self.queue.popleft()
+                job.taken = True
+                cancelled = job.cancelled
+            finally:
+                self.condition.release()
+            if not cancelled:
+                self._render(job)
+            # the job is removed from the list of jobs in the clutter
+            # thread even if it was cancelled
+            gobject.timeout_add(0, self._upload, job)
+
+    def _render(self, job):
+        """
+        Render the text into an image buffer
+        Executed in the worker threads
+        """
+        t0 = time.time()
+        try:
+            width, height = job.size
+            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+            job.render(cairo.Context(surface), *job.params)
+            surface.flush()
+            job.result = str(surface.get_data()), width, height, surface.get_stride()
+            self.condition.acquire()
+            self.stats['rendered'] += 1
+            self.stats['render_time'] += time.time() - t0
+            self.condition.release()
+        except Exception, e:
+            log.exception('unable to render text')
+            self.condition.acquire()
+            self.stats['failed'] += 1
+            self.condition.release()
+
+    def _upload(self, job):
+        """
+        Pass the rendered text to the widget
+        Executed in the clutter thread
+        """
+        if self.jobs.get(job.key) is job:
+            del self.jobs[job.key]
+        if job.result is not None:
+            self._store(job.key, job.result)
+        if job.cancelled:
+            self.stats['cancelled'] += 1
+            return False
+        for callback in job.callbacks:
+            t0 = time.time()
+            try:
+                callback(job.result)
+            except Exception, e:
+                log.exception('unable to upload text')
+            if job.result is not None:
+                self.stats['uploaded'] += 1
+                self.stats['upload_time'] += time.time() - t0
+        return False
+
+    def _store(self, key, result):
+        """
+        Add the result to the cache
+        """
+        if key in self.cache:
+            return
+        self.cache[key] = result
+        self.cache_size += len(result[0])
+        budget = self.config.get('text_cache', 8) * 1024 * 1024
+        while self.cache_size > budget and len(self.cache) > 1:
+            self.cache_size -= len(self.cache.popitem(last=False)[1][0])
+
+# global rasterizer object
+rasterizer = Rasterizer()
+
+class GlyphCache(object):
+    """
+    Alpha masks of the glyphs used by labels. The cache is used by
+    all worker threads.
+    """
+    def __init__(self):
+        # (mask, x offset, y offset, advance) by (font, size, char),
+        # least recently used first
+        self.glyphs = collections.OrderedDict()
+        # ascent by (font, size)
+        self.ascent = {}
+        self.lock = threading.Lock()
+        # options from the application, set by init()
+        self.config = {}
+        self.stats = { 'hits': 0, 'misses': 0, 'evicted': 0 }
+
+    def layout(self, font, size, text, width):
+        """
+        Return the (mask, x, y) of the glyphs of the text visible in
+        the given width and the width of the whole text.
+        """
+        if isinstance(text, str):
+            text = text.decode('utf-8')
+        ascent = self.ascent.get((font, size))
+        if ascent is None:
+            ascent = self.ascent[font, size] = self._context(font, size).font_extents()[0]
+        x, glyphs = 0.0, []
+        for char in text:
+            mask, dx, dy, advance = self._get(font, size, char)
+            if mask is not None and x < width:
+                glyphs.append((mask, int(round(x)) + dx, int(round(ascent)) + dy))
+            x += advance
+        return glyphs, x
+
+    def get_stats(self):
+        """
+        Return the statistics of the cache
+        """
+        stats = self.stats.copy()
+        stats['glyphs'] = len(self.glyphs)
+        stats['fonts'] = len(self.ascent)
+        return stats
+
+    def _get(self, font, size, char):
+        """
+        Return the glyph from the cache or render it
+        """
+        key = font, size, char
+        self.lock.acquire()
+        try:
+            glyph = self.glyphs.pop(key, None)
+            if glyph is not None:
+                self.stats['hits'] += 1
+                self.glyphs[key] = glyph
+                return glyph
+        finally:
+            self.lock.release()
+        glyph = self._render(font, size, char)
+        self.lock.acquire()
+        try:
+            self.stats['misses'] += 1
+            self.glyphs[key] = glyph
+            while len(self.glyphs) > self.config.get('text_glyph_cache', 4096):
+                self.glyphs.popitem(last=False)
+                self.stats['evicted'] += 1
+        finally:
+            self.lock.release()
+        return glyph
+
+    def _context(self, font, size, surface=None):
+        """
+        Return a cairo context with the font selected
+        """
+        if surface is None:
+            surface = cairo.ImageSurface(cairo.FORMAT_A8, 1, 1)
+        cr = cairo.Context(surface)
+        cr.select_font_face(font, cairo.FONT_SLANT_NORMAL)
+        cr.set_font_size(size)
+        return cr
+
+    def _render(self, font, size, char):
+        """
+        Render the glyph into an alpha mask with one pixel border
+        """
+        x, y, width, height, advance = self._context(font, size).text_extents(char)[:5]
+        if not width or not height:
+            # whitespace
+            return None, 0, 0, advance
+        x0, y0 = int(math.floor(x)) - 1, int(math.floor(y)) - 1
+        mask = cairo.ImageSurface(cairo.FORMAT_A8,
+            int(math.ceil(x + width)) + 1 - x0, int(math.ceil(y + height)) + 1 - y0)
+        cr = self._context(font, size, mask)
+        cr.move_to(-x0, -y0)
+        cr.show_text(char)
+        mask.flush()
+        return mask, x0, y0, advance
+
+# global glyph cache
+glyphs = GlyphCache()
+
+class RasterTexture(image.CairoTexture):
+    """
+    CairoTexture rendered in a worker thread. Subclasses provide the
+    render function and its parameters.
+    """
+
+    # text waiting for the rasterizer
+    job = None
+    # True if the widget uses a ClutterImage
+    threaded = False
+
+    def create(self):
+        """
+        Create the clutter object
+        """
+        if not rasterizer.available:
+            return super(RasterTexture, self).create()
+        self.threaded = True
+        self.obj = clutter.Actor()
+        self.content = clutter.Image.new()
+        self.obj.set_content(self.content)
+        self.obj.show()
+
+    @staticmethod
+    def render(cr, *params):
+        """
+        Render the text; executed in a worker thread
+        """
+        pass
+
+    def get_params(self):
+        """
+        Return the arguments for render. They are also used as key
+        for the cache and must be hashable.
+        """
+        return ()
+
+    def draw(self, cr):
+        """
+        Render the cairo context in the clutter thread
+        """
+        t0 = time.time()
+        self.render(cr, *self.get_params())
+        rasterizer.stats['painted'] += 1
+        rasterizer.stats['paint_time'] += time.time() - t0
+        return True
+
+    def update(self, modified):
+        """
+        Render the widget
+        """
+        if not self.threaded:
+            return super(RasterTexture, self).update(modified)
+        widget.Widget.update(self, modified)
+        for attribute in 'opacity', 'scale_x', 'scale_y', 'anchor_point', 'visible', 'xalign', 'yalign':
+            if attribute in modified:
+                modified.pop(attribute)
+        if modified:
+            self.rasterize()
+
+    def rasterize(self):
+        """
+        Render the text in a worker thread or use the cached result
+        """
+        if self.job:
+            self.job.cancel(self.upload)
+            self.job = None
+        if not self.width or not self.height:
+            return
+        params = self.get_params()
+        key = (self.__class__.__name__, self.width, self.height) + params
+        result = rasterizer.get(key)
+        if result is not None:
+            return self.upload(result)
+        self.job = rasterizer.submit(key, self.render, params, (self.width, self.height), self.upload)
+
+    def upload(self, result):
+        """
+        Set the rendered text
+        Executed in the clutter thread
+        """
+        self.job = None
+        if result is None or self.obj is None:
+            return
+        data, width, height, stride = result
+        self.content.set_data(data, PIXEL_FORMAT, width, height, stride)
+
+    def delete(self):
+        """
+        Delete the clutter object
+        """
+        if self.job:
+            self.job.cancel(self.upload)
+            self.job = None
+        super(RasterTexture, self).delete()
+
+def init(server):
+    """
+    Connect the rasterizer and the glyph cache to the server
+    """
+    rasterizer.config = glyphs.config = server.config
+    server.register_stats('text', rasterizer.get_stats)
+    server.register_stats('glyphs', glyphs.get_stats)
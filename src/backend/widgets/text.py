@@ -32,22 +32,32 @@ __all__ = [ 'Text' ]
 
 from gi.repository import Pango, PangoCairo
 
-import image
+# kaa.candy imports
+import raster
 
-class Text(image.CairoTexture):
+class Text(raster.RasterTexture):
 
-    def draw(self, cr):
+    def get_params(self):
+        """
+        Return the arguments for render
+        """
+        color = self.color and tuple(self.color.to_cairo())
+        return self.text, self.font.name, self.font.size, color, str(self.align), \
+            self.width, self.height
+
+    @staticmethod
+    def render(cr, text, font, size, color, align, width, height):
         """
         Render the cairo context
         """
-        if self.color:
-            cr.set_source_rgba(*self.color.to_cairo())
+        if color:
+            cr.set_source_rgba(*color)
         layout = PangoCairo.create_layout(cr)
-        layout.set_width(self.width * Pango.SCALE)
-        layout.set_height(self.height * Pango.SCALE)
+        layout.set_width(width * Pango.SCALE)
+        layout.set_height(height * Pango.SCALE)
         layout.set_ellipsize(Pango.EllipsizeMode.END)
-        layout.set_alignment(getattr(Pango.Alignment, str(self.align).upper()))
+        layout.set_alignment(getattr(Pango.Alignment, align.upper()))
         layout.set_wrap(Pango.WrapMode.WORD_CHAR)
-        layout.set_font_description(self.font.get_font_description())
-        layout.set_text(self.text, -1)
+        layout.set_font_description(Pango.FontDescription.from_string('%s %spx' % (font, size)))
+        layout.set_text(text, -1)
         PangoCairo.show_layout(cr, layout)
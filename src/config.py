@@ -37,3 +37,86 @@ imagepath = []
 
 # debug variable to find performance problems
 performance_debug = False
+
+# Send syncs only moving existing widgets through a ring buffer in
+# shared memory instead of the rpc connection. The number of slots
+# limits the updates between two frames of the backend.
+shm_transport = False
+shm_slots = 4096
+
+# Maximum number of syncs sent to the backend and not yet applied by
+# the clutter thread. Further changes are collected until the backend
+# acknowledges a sync.
+sync_max_pending = 2
+
+# Refresh rate of the display and the fraction of each frame the
+# backend may spend on applying changes before going back to clutter.
+frame_rate = 60
+frame_budget = 0.5
+
+# Rows and columns kept around the visible area of a virtual grid and
+# the maximum number of cells kept for reuse after scrolling out of
+# that area. Cells not fitting in the pool are destroyed.
+grid_virtual_margin = 1
+grid_virtual_pool = 32
+
+# Number of threads decoding images in the backend and the maximum
+# number of images waiting for them. If the queue is full, images are
+# loaded in the clutter thread.
+decoder_threads = 2
+decoder_queue = 64
+
+# Memory budget in MB for image textures in the backend not used by
+# any widget. Widgets showing the same file share one texture.
+texture_cache = 64
+
+# Number of image geometries read from file headers kept in memory
+# and an optional file to store them between runs.
+imageinfo_cache = 4096
+imageinfo_store = None
+
+# Maximum number of remote images downloaded at the same time, the
+# number of retries for failed downloads with a delay starting at
+# download_backoff seconds and doubled for each retry, and the socket
+# timeout in seconds. Downloaded files are checked for updates on the
+# server after download_revalidate seconds; set it to None to keep
+# them forever.
+download_max = 4
+download_retries = 3
+download_backoff = 1.0
+download_timeout = 30
+download_revalidate = 86400
+
+# Maximum size in MB of the downloaded images in the candy-images
+# directory. If set, the cache also stores the images scaled to the
+# size shown on screen.
+diskcache_size = 256
+diskcache_variants = False
+
+# Maximum number of thumbnail creations and item scans sent to
+# kaa.beacon at the same time. Requests for visible widgets are sent
+# first.
+thumbnail_max = 4
+
+# Images up to atlas_image_size pixels in width and height are packed
+# into shared textures of atlas_size x atlas_size pixels. At most
+# atlas_count of these textures are created. Set atlas_image_size to 0
+# to give each image its own texture.
+atlas_image_size = 64
+atlas_size = 1024
+atlas_count = 4
+
+# Number of text and font measurements of Label and Text widgets
+# kept in a cache shared by all widgets.
+text_measure_cache = 4096
+
+# Label and Text widgets are rendered by text_threads worker threads
+# in the backend. The rendered text is kept in a cache of text_cache
+# MB and widgets with the same text, font and size share it. Set
+# text_threads to 0 to render the text in the clutter thread.
+text_threads = 2
+text_cache = 8
+
+# Labels are composed from glyphs rendered once per font and size.
+# The cache keeps text_glyph_cache glyphs of all fonts.
+text_glyph_cache = 4096
@@ -34,16 +34,22 @@
 #
 # -----------------------------------------------------------------------------
 
-__all__ = [ 'Context', 'Color', 'Font' ]
+__all__ = [ 'Context', 'OrderedSet', 'LRUCache', 'Expression', 'TextTemplate', 'Color', 'Font' ]
 
 # python imports
+import re
 import logging
+import collections
 import cairo
 
-from gi.repository import Pango
+from gi.repository import Pango, PangoCairo
 
 # kaa imports
 import kaa
+import kaa.base
+
+# kaa.candy imports
+import config
 
 # get logging object
 log = logging.getLogger('kaa.candy')
@@ -59,16 +65,252 @@ class Context(dict):
         if attr.startswith('$'):
             # strip prefix for variables if set
             attr = attr[1:]
+        return get_expression(attr).evaluate(self, default)
+
+    def __getattr__(self, attr):
+        return self.get(attr)
+
+
+class OrderedSet(object):
+    """
+    Set keeping the insertion order. Adding, removing and membership
+    tests are O(1). The items are stored in a linked list with a dict
+    mapping each item to its [prev, next, item] node.
+    """
+    def __init__(self, items=()):
+        self.__map = {}
+        # sentinel node of the circular list
+        self.__end = end = []
+        end += [ end, end, None ]
+        for item in items:
+            self.add(item)
+
+    def __len__(self):
+        return len(self.__map)
+
+    def __nonzero__(self):
+        return len(self.__map) > 0
+
+    def __contains__(self, item):
+        return item in self.__map
+
+    def __iter__(self):
+        end = self.__end
+        node = end[1]
+        while node is not end:
+            yield node[2]
+            node = node[1]
+
+    def __repr__(self):
+        return '<OrderedSet %r>' % list(self)
+
+    def add(self, item):
+        """
+        Add the item at the end if it is not in the set
+        """
+        if item not in self.__map:
+            end = self.__end
+            last = end[0]
+            last[1] = end[0] = self.__map[item] = [ last, end, item ]
+
+    def append(self, item):
+        """
+        Alias for add to be used like a list
+        """
+        self.add(item)
+
+    def insert_after(self, item, new):
+        """
+        Move or add new directly behind item
+        """
+        self.discard(new)
+        prev = self.__map[item]
+        succ = prev[1]
+        prev[1] = succ[0] = self.__map[new] = [ prev, succ, new ]
+
+    def discard(self, item):
+        """
+        Remove the item if it is in the set
+        """
+        if item in self.__map:
+            prev, succ, item = self.__map.pop(item)
+            prev[1] = succ
+            succ[0] = prev
+
+    def remove(self, item):
+        """
+        Remove the item, raises KeyError if it is not in the set
+        """
+        if item not in self.__map:
+            raise KeyError(item)
+        self.discard(item)
+
+    def pop(self, last=False):
+        """
+        Remove and return the first or the last item
+        """
+        if not self.__map:
+            raise KeyError('set is empty')
+        item = self.__end[0][2] if last else self.__end[1][2]
+        self.discard(item)
+        return item
+
+
+class LRUCache(object):
+    """
+    Dict with a maximum number of items. Adding an item to a full
+    cache removes the least recently used one. Lookups are counted as
+    hits and misses.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.hits = self.misses = 0
+        self.__data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.__data)
+
+    def __contains__(self, key):
+        return key in self.__data
+
+    def __setitem__(self, key, value):
+        if key in self.__data:
+            del self.__data[key]
+        elif len(self.__data) >= self.size:
+            self.__data.popitem(last=False)
+        self.__data[key] = value
+
+    def __delitem__(self, key):
+        del self.__data[key]
+
+    def get(self, key, default=None):
+        """
+        Return the value for key and mark it as recently used
+        """
+        try:
+            value = self.__data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.__data[key] = value
+        return value
+
+    def items(self):
+        """
+        Return the items, the least recently used first
+        """
+        return self.__data.items()
+
+    def clear(self):
+        """
+        Remove all items
+        """
+        self.__data.clear()
+
+
+class Expression(object):
+    """
+    Compiled expression evaluated in a context. Variables and their
+    attributes like C{item.title} are looked up directly, only other
+    expressions are evaluated with eval.
+    """
+
+    __path_regexp = re.compile('^[a-zA-Z_][a-zA-Z0-9_]*(\.[a-zA-Z_][a-zA-Z0-9_]*)*$')
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.path = None
+        if self.__path_regexp.match(expr):
+            self.path = expr.split('.')
+        try:
+            self.code = compile(expr, '<context>', 'eval')
+        except SyntaxError, e:
+            self.code = None
+
+    def evaluate(self, context, default=None):
+        """
+        Return the value of the expression in the context or default
+        if the evaluation fails.
+        """
         try:
-            # try the variable as it is
-            value = eval(attr, self)
-            return value
+            if self.path and self.path[0] in context:
+                value = context[self.path[0]]
+                for attr in self.path[1:]:
+                    value = getattr(value, attr)
+                return value
+            # builtins like None or a real expression
+            return eval(self.code, context)
         except Exception, e:
-            log.error('unable to evaluate %s', attr)
+            log.error('unable to evaluate %s', self.expr)
             return default
 
-    def __getattr__(self, attr):
-        return self.get(attr)
+
+class TextTemplate(object):
+    """
+    Text with C{$var} or C{${expression}} variables, compiled into
+    literal chunks and expressions.
+    """
+
+    __regexp = re.compile('\$([a-zA-Z][a-zA-Z0-9_\.]*)|\${([^}]*)}')
+
+    def __init__(self, text):
+        self.literals = []
+        self.expressions = []
+        pos = 0
+        for match in self.__regexp.finditer(text):
+            self.literals.append(text[pos:match.start()])
+            self.expressions.append(get_expression(match.group(1) or match.group(2)))
+            pos = match.end()
+        self.literals.append(text[pos:])
+
+    def evaluate(self, context):
+        """
+        Return the text of the variables in the context. The strings
+        are compared to detect changes; the values may be mutable
+        objects changed in place.
+        """
+        chunks = []
+        for e in self.expressions:
+            value = e.evaluate(context, '')
+            if value is None:
+                chunks.append('')
+            else:
+                chunks.append(kaa.base.py3_str(value, coerce=True))
+        return tuple(chunks)
+
+    def render(self, chunks):
+        """
+        Return the text with the variables replaced by the chunks
+        returned by evaluate
+        """
+        result = [ self.literals[0] ]
+        for chunk, literal in zip(chunks, self.literals[1:]):
+            result.append(chunk)
+            result.append(literal)
+        return ''.join(result)
+
+# compiled expressions and templates by string
+_expressions = LRUCache(1024)
+_templates = LRUCache(1024)
+
+def get_expression(expr):
+    """
+    Return the compiled Expression for the string
+    """
+    expression = _expressions.get(expr)
+    if expression is None:
+        expression = _expressions[expr] = Expression(expr)
+    return expression
+
+def get_template(text):
+    """
+    Return the compiled TextTemplate for the text
+    """
+    template = _templates.get(text)
+    if template is None:
+        template = _templates[text] = TextTemplate(text)
+    return template
 
 
 class Color(list):
@@ -124,6 +366,48 @@ def create_cairo_context():
     """
     return cairo.Context(_font_cairo_surface)
 
+# Measurements of text by font, size and text plus the layout
+# parameters shared by all widgets. The cache also holds the font
+# heights by size and the font sizes fitting a given height. The
+# cairo and Pango contexts are created on first use and reused for
+# all measurements.
+measurements = None
+_measure_cairo = None
+_measure_pango = None
+
+def _get_measurements():
+    """
+    Return the measurement cache
+    """
+    global measurements
+    if measurements is None:
+        measurements = LRUCache(config.text_measure_cache)
+    return measurements
+
+def measure_text(font, text, width, height, ellipsize=True):
+    """
+    Return the size of the text rendered with Pango in the given
+    width and height. The text is wrapped at words or characters and
+    ellipsized at the end if ellipsize is True.
+    """
+    global _measure_pango
+    key = 'pango', font.name, font.size, text, width, height, ellipsize
+    size = _get_measurements().get(key)
+    if size is None:
+        if _measure_pango is None:
+            _measure_pango = PangoCairo.FontMap.get_default().create_context()
+        layout = Pango.Layout.new(_measure_pango)
+        layout.set_width(width * Pango.SCALE)
+        layout.set_height(height * Pango.SCALE)
+        if ellipsize:
+            layout.set_ellipsize(Pango.EllipsizeMode.END)
+        layout.set_wrap(Pango.WrapMode.WORD_CHAR)
+        layout.set_font_description(font.get_font_description())
+        layout.set_text(text, -1)
+        size = layout.get_size()
+        size = Pango.units_to_double(size[0]), Pango.units_to_double(size[1])
+        measurements[key] = size
+    return size
 
 class Font(object):
     """
@@ -133,10 +417,11 @@ class Font(object):
     @ivar size: font size
     """
 
-    __height_cache = {}
-
     ASCENT, TYPICAL, MAX_HEIGHT = range(3)
 
+    # font size used to estimate the size for a given height
+    FIT_REFERENCE = 100
+
     def __init__(self, name):
         """
         Create a new font object
@@ -148,22 +433,37 @@ class Font(object):
             self.name, size = name.split(':')
             self.size = int(size)
 
+    def __eq__(self, other):
+        if not isinstance(other, Font):
+            return False
+        return self.name == other.name and self.size == other.size
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self.name, self.size))
+
     def get_height(self, field=None, size=None):
         """
         Get height of a text with this font.
         @returns: ascent (typical height above the baseline), normal (typical height
             of a string without special characters) and ascent + descent
         """
+        global _measure_cairo
         if size is None:
             size = self.size
-        info = self.__height_cache.get((self.name, size))
+        key = 'height', self.name, size
+        info = _get_measurements().get(key)
         if info is None:
-            c = create_cairo_context()
+            if _measure_cairo is None:
+                _measure_cairo = create_cairo_context()
+            c = _measure_cairo
             c.select_font_face(self.name, cairo.FONT_SLANT_NORMAL)
             c.set_font_size(size)
             ascent, descent = c.font_extents()[:2]
             info = int(ascent), int(-c.text_extents(u'Ag')[1]), int(ascent + descent)
-            self.__height_cache[(self.name, size)] = info
+            measurements[key] = info
         if field is None:
             return info
         return info[field]
@@ -172,29 +472,65 @@ class Font(object):
         """
         Get width of the given string
         """
-        c = create_cairo_context()
-        c.select_font_face(self.name, cairo.FONT_SLANT_NORMAL)
-        c.set_font_size(self.size)
-        # add x_bearing to width (maybe use x_advance later)
-        # http://cairographics.org/manual/cairo-Scaled-Fonts.html#cairo-text-extents-t
-        ext = c.text_extents(text)
-        return int(ext[0] + ext[2]) + 1
+        global _measure_cairo
+        key = 'cairo', self.name, self.size, text
+        width = _get_measurements().get(key)
+        if width is None:
+            if _measure_cairo is None:
+                _measure_cairo = create_cairo_context()
+            c = _measure_cairo
+            c.select_font_face(self.name, cairo.FONT_SLANT_NORMAL)
+            c.set_font_size(self.size)
+            # add x_bearing to width (maybe use x_advance later)
+            # http://cairographics.org/manual/cairo-Scaled-Fonts.html#cairo-text-extents-t
+            ext = c.text_extents(text)
+            width = measurements[key] = int(ext[0] + ext[2]) + 1
+        return width
 
     def get_font(self, height):
         """
         Get font object with size set to fit the given height.
         """
-        size = 1
-        last = None
-        while True:
-            if not self.__height_cache.get((self.name, size)):
-                self.get_height(size=size)
-            if self.__height_cache.get((self.name, size))[Font.MAX_HEIGHT] > height:
-                f = Font(self.name)
-                f.size = size - 1
-                return f
-            last = size
-            size += 1
+        key = 'fit', self.name, height
+        size = _get_measurements().get(key)
+        if size is None:
+            size = measurements[key] = self._fit(height)
+        font = Font(self.name)
+        font.size = size
+        return font
+
+    def _fit(self, height):
+        """
+        Return the largest size with a height not exceeding the given
+        height. The height grows about linearly with the size, so the
+        search starts at the size interpolated from the reference size
+        and only needs a few measurements around it.
+        """
+        def fits(size):
+            return self.get_height(Font.MAX_HEIGHT, size) <= height
+        reference = self.get_height(Font.MAX_HEIGHT, Font.FIT_REFERENCE)
+        guess = max(int(height * Font.FIT_REFERENCE / max(reference, 1)), 1)
+        # find sizes lo fitting and hi not fitting by increasing steps
+        # around the guess; size 0 always fits
+        step = 1
+        if fits(guess):
+            lo, hi = guess, guess + step
+            while fits(hi):
+                step *= 2
+                lo, hi = hi, hi + step
+        else:
+            lo, hi = max(guess - step, 0), guess
+            while lo and not fits(lo):
+                step *= 2
+                lo, hi = max(lo - step, 0), lo
+        # binary search between them
+        while hi - lo > 1:
+            size = (lo + hi) / 2
+            if fits(size):
+                lo = size
+            else:
+                hi = size
+        return lo
 
     def get_font_description(self):
         """
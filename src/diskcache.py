@@ -0,0 +1,287 @@
+# -*- coding: iso-8859-1 -*-
+# -----------------------------------------------------------------------------
+# diskcache.py - Size limited cache for downloaded images
+# -----------------------------------------------------------------------------
+# Remote images are stored in the candy-images directory in the kaa
+# temp directory, named by the MD5 of the url. The cache keeps an
+# index with size and access time of all files, stored in the
+# directory to avoid scanning it on startup. If the files exceed
+# config.diskcache_size, the least recently used ones are deleted.
+# Optionally, the cache also stores variants of the images scaled to
+# the size shown on screen.
+#
+# -----------------------------------------------------------------------------
+# kaa-candy - Fourth generation Canvas System using Clutter as backend
+# Copyright (C) 2013 Dirk Meyer
+#
+# First Version: Dirk Meyer <https://github.com/Dischi>
+# Maintainer:    Dirk Meyer <https://github.com/Dischi>
+#
+# Based on various previous attempts to create a canvas system for
+# Freevo by Dirk Meyer and Jason Tackaberry.  Please see the file
+# AUTHORS for a complete list of authors.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MER-
+# CHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+# -----------------------------------------------------------------------------
+
+__all__ = [ 'DiskCache', 'images' ]
+
+# python imports
+import os
+import time
+import hashlib
+import logging
+import cPickle
+import collections
+
+# kaa imports
+import kaa
+import kaa.imlib2
+
+# kaa.candy imports
+import config
+import download
+
+# get logging object
+log = logging.getLogger('kaa.candy')
+
+@kaa.threaded()
+def _scale(filename, variant, size):
+    """
+    Save the image scaled to size as variant
+    Executed in a thread
+    """
+    kaa.imlib2.Image(filename).scale(size).save(variant)
+
+
+class DiskCache(object):
+    """
+    Files in a directory with LRU eviction
+    """
+    def __init__(self, name):
+        self.name = name
+        self.directory = None
+        # (size, access time) by file name, least recently used first;
+        # created on first use
+        self.index = None
+        self.size = 0
+        # files currently downloading or scaling
+        self.pending = set()
+        self.stats = { 'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0, 'variants': 0 }
+        self.__save_timer = kaa.OneShotTimer(self.save)
+
+    def _load(self):
+        """
+        Load the index or create it from the files in the directory
+        """
+        self.directory = os.path.dirname(kaa.tempfile(self.name + '/index'))
+        self.index = collections.OrderedDict()
+        indexfile = os.path.join(self.directory, 'index')
+        kaa.main.signals['shutdown'].connect(self.save)
+        if os.path.isfile(indexfile):
+            try:
+                for name, size, atime in cPickle.load(open(indexfile, 'rb')):
+                    self.index[name] = size, atime
+                    self.size += size
+                return
+            except Exception, e:
+                log.error('unable to load %s: %s', indexfile, e)
+                self.index.clear()
+                self.size = 0
+        # no index, scan the directory once
+        files = []
+        for name in os.listdir(self.directory):
+            if name == 'index' or name.endswith(('.meta', '.tmp')):
+                continue
+            stat = os.stat(os.path.join(self.directory, name))
+            files.append((stat.st_atime, name, stat.st_size))
+        for atime, name, size in sorted(files):
+            self.index[name] = size, atime
+            self.size += size
+        self.evict()
+
+    def save(self):
+        """
+        Write the index to the cache directory
+        """
+        if self.index is None:
+            return
+        indexfile = os.path.join(self.directory, 'index')
+        try:
+            data = [ (name, size, atime) for name, (size, atime) in self.index.items() ]
+            cPickle.dump(data, open(indexfile + '.tmp', 'wb'), cPickle.HIGHEST_PROTOCOL)
+            os.rename(indexfile + '.tmp', indexfile)
+        except Exception, e:
+            log.error('unable to save %s: %s', indexfile, e)
+
+    def _changed(self):
+        """
+        Save the index later
+        """
+        if not self.__save_timer.active:
+            self.__save_timer.start(10)
+
+    def filename(self, url):
+        """
+        Return the cache filename for the url
+        """
+        if self.index is None:
+            self._load()
+        base = hashlib.md5(url).hexdigest() + os.path.splitext(url)[1]
+        return os.path.join(self.directory, base)
+
+    def managed(self, filename):
+        """
+        Return True if the file is in the cache directory
+        """
+        if self.index is None:
+            self._load()
+        return os.path.dirname(filename) == self.directory
+
+    def lookup(self, filename):
+        """
+        Mark the file as used. Returns True if it is in the cache.
+        """
+        if self.index is None:
+            self._load()
+        name = os.path.basename(filename)
+        entry = self.index.pop(name, None)
+        if entry is None:
+            self.stats['misses'] += 1
+            return False
+        self.stats['hits'] += 1
+        self.index[name] = entry[0], time.time()
+        self._changed()
+        return True
+
+    def add(self, filename):
+        """
+        Add a new or updated file to the cache
+        """
+        if self.index is None:
+            self._load()
+        name = os.path.basename(filename)
+        try:
+            size = os.stat(filename).st_size
+        except OSError:
+            return
+        old = self.index.pop(name, None)
+        if old is not None:
+            self.size -= old[0]
+            # scaled variants of the old file are outdated
+            base = os.path.splitext(name)[0] + '-'
+            for variant in [ n for n in self.index if n.startswith(base) ]:
+                self.remove(variant)
+        self.index[name] = size, time.time()
+        self.size += size
+        self.stats['stored'] += 1
+        self.evict()
+        self._changed()
+
+    def remove(self, name):
+        """
+        Delete the file with the given name
+        """
+        size, atime = self.index.pop(name)
+        self.size -= size
+        filename = os.path.join(self.directory, name)
+        for f in (filename, filename + '.meta'):
+            if os.path.exists(f):
+                os.unlink(f)
+
+    def evict(self):
+        """
+        Delete least recently used files until the cache fits into
+        config.diskcache_size
+        """
+        budget = config.diskcache_size * 1024 * 1024
+        for name in self.index.keys():
+            if self.size <= budget:
+                break
+            if os.path.join(self.directory, name) in self.pending:
+                continue
+            self.remove(name)
+            self.stats['evicted'] += 1
+
+    def fetch(self, url, owner=None, priority=0):
+        """
+        Return the cache filename for the url and the InProgress
+        object of the download from kaa.candy.download or None if the
+        file is up to date.
+        """
+        filename = self.filename(url)
+        self.lookup(filename)
+        inprogress = download.fetch(url, filename, owner, priority)
+        if inprogress is not None and not filename in self.pending:
+            self.pending.add(filename)
+            inprogress.connect_once(self._downloaded, filename)
+        return filename, inprogress
+
+    def _downloaded(self, changed, filename):
+        """
+        Callback from the download manager
+        """
+        self.pending.discard(filename)
+        if changed:
+            self.add(filename)
+
+    def get_variant(self, filename, size):
+        """
+        Return the filename of the image scaled to size or None if
+        the cache has no such file.
+        """
+        base, ext = os.path.splitext(filename)
+        variant = '%s-%sx%s%s' % (base, size[0], size[1], ext)
+        if self.lookup(variant):
+            return variant
+        return None
+
+    @kaa.coroutine()
+    def create_variant(self, filename, size):
+        """
+        Scale the image in a thread and store it in the cache. The
+        returned InProgress object is finished with True if the
+        variant was created.
+        """
+        base, ext = os.path.splitext(filename)
+        variant = '%s-%sx%s%s' % (base, size[0], size[1], ext)
+        if not self.managed(filename) or variant in self.pending:
+            yield False
+        self.pending.add(variant)
+        try:
+            yield _scale(filename, variant, size)
+            self.stats['variants'] += 1
+            self.add(variant)
+            yield True
+        except Exception, e:
+            log.error('unable to scale %s: %s', filename, e)
+            yield False
+        finally:
+            self.pending.discard(variant)
+
+    def get_stats(self):
+        """
+        Return the statistics of the cache
+        """
+        if self.index is None:
+            self._load()
+        stats = self.stats.copy()
+        stats['entries'] = len(self.index)
+        stats['bytes'] = self.size
+        return stats
+
+# cache for remote images
+images = DiskCache('candy-images')
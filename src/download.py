@@ -0,0 +1,433 @@
+# -*- coding: iso-8859-1 -*-
+# -----------------------------------------------------------------------------
+# download.py - Download manager for remote images
+# -----------------------------------------------------------------------------
+# Remote images are downloaded into a local cache file before the
+# Image widget can show them. This module runs at most
+# config.download_max downloads at the same time in worker threads,
+# keeps the HTTP connections to each host open for the next request
+# and starts downloads for visible widgets first. A download nobody
+# is waiting for anymore because all requesting widgets are deleted
+# is dropped before it starts. Failed downloads are retried with an
+# increasing delay. The ETag and Last-Modified headers are stored
+# next to the cache file and used to check the file for updates
+# after config.download_revalidate seconds.
+#
+# -----------------------------------------------------------------------------
+# kaa-candy - Fourth generation Canvas System using Clutter as backend
+# Copyright (C) 2013 Dirk Meyer
+#
+# First Version: Dirk Meyer <https://github.com/Dischi>
+# Maintainer:    Dirk Meyer <https://github.com/Dischi>
+#
+# Based on various previous attempts to create a canvas system for
+# Freevo by Dirk Meyer and Jason Tackaberry.  Please see the file
+# AUTHORS for a complete list of authors.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MER-
+# CHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+# -----------------------------------------------------------------------------
+
+__all__ = [ 'fetch', 'set_priority', 'expired', 'get_stats', 'DownloadError' ]
+
+# python imports
+import os
+import time
+import heapq
+import socket
+import httplib
+import urlparse
+import logging
+import weakref
+import cPickle
+import threading
+
+# kaa imports
+import kaa
+
+# kaa.candy imports
+import config
+
+# get logging object
+log = logging.getLogger('kaa.candy')
+
+# Checking an existing cache file for updates is less important than
+# any download of a missing file.
+PRIORITY_REVALIDATE = 10
+
+# HTTP status codes worth another try, all other errors are permanent
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+
+# maximum number of redirects followed for one request
+MAX_REDIRECTS = 5
+
+class DownloadError(Exception):
+    """
+    Unexpected HTTP status code
+    """
+    def __init__(self, status, reason):
+        Exception.__init__(self, '%s %s' % (status, reason))
+        self.status = status
+        self.retry = status in RETRY_STATUS
+
+
+class Job(object):
+    """
+    Download of an url into a cache file
+    """
+    def __init__(self, url, filename, revalidate):
+        self.url = url
+        self.filename = filename
+        self.revalidate = revalidate
+        # priority requested by the owners and the position in the
+        # queue based on it
+        self.base = None
+        self.priority = None
+        # weak references to the widgets waiting for the download; a
+        # download without owner is never dropped
+        self.owners = []
+        self.anonymous = False
+        # queued, running or backoff
+        self.state = 'queued'
+        self.attempts = 0
+        self.timer = None
+        self.inprogress = kaa.InProgress()
+
+    def add_owner(self, owner):
+        """
+        Add a widget waiting for the download
+        """
+        if owner is None:
+            self.anonymous = True
+        else:
+            self.owners.append(weakref.ref(owner))
+
+    @property
+    def alive(self):
+        """
+        True if somebody is still waiting for the download
+        """
+        if self.anonymous:
+            return True
+        self.owners = [ ref for ref in self.owners if ref() is not None ]
+        return len(self.owners) > 0
+
+
+class DownloadManager(object):
+    """
+    Queue of downloads with a limited number of worker threads
+    """
+    def __init__(self):
+        # jobs waiting or running by cache filename
+        self.jobs = {}
+        self.queue = []
+        # counter to keep the order of jobs with the same priority
+        self.counter = 0
+        self.running = 0
+        # idle connections by (scheme, host)
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.stats = {
+            'requests': 0, 'downloaded': 0, 'not_modified': 0, 'failed': 0,
+            'retried': 0, 'cancelled': 0, 'connections': 0, 'reused': 0, 'bytes': 0 }
+
+    def fetch(self, url, filename, owner=None, priority=0):
+        """
+        Download the url into filename unless the file exists and was
+        checked for updates recently. The owner is the widget waiting
+        for the file. Returns an InProgress object finished with True
+        if the file was written and False if not or None if there is
+        nothing to do.
+        """
+        job = self.jobs.get(filename)
+        if job is None:
+            revalidate = os.path.isfile(filename)
+            if revalidate and not self.expired(filename):
+                return None
+            job = Job(url, filename, revalidate)
+            self.jobs[filename] = job
+            self.stats['requests'] += 1
+            job.add_owner(owner)
+            self.set_priority(filename, priority)
+            self._schedule()
+            return job.inprogress
+        job.add_owner(owner)
+        if priority < job.base:
+            self.set_priority(filename, priority)
+        return job.inprogress
+
+    def set_priority(self, filename, priority):
+        """
+        Change the priority of the download for filename. Lower
+        values are started first.
+        """
+        job = self.jobs.get(filename)
+        if job is None or job.base == priority:
+            return
+        job.base = priority
+        job.priority = priority
+        if job.revalidate:
+            job.priority += PRIORITY_REVALIDATE
+        if job.state == 'queued':
+            # the old entry in the heap is skipped because it does
+            # not match the priority anymore
+            self._push(job)
+
+    def expired(self, filename):
+        """
+        Return True if the cache file should be checked for updates
+        """
+        if config.download_revalidate is None:
+            return False
+        try:
+            checked = os.stat(filename + '.meta').st_mtime
+        except OSError:
+            # no information about the remote file
+            return True
+        return time.time() - checked > config.download_revalidate
+
+    def close(self):
+        """
+        Close all idle connections
+        """
+        self.lock.acquire()
+        try:
+            for idle in self.connections.values():
+                for connection in idle:
+                    connection.close()
+            self.connections = {}
+        finally:
+            self.lock.release()
+
+    def get_stats(self):
+        """
+        Return the statistics of the manager
+        """
+        stats = self.stats.copy()
+        stats['running'] = self.running
+        stats['queued'] = len([ j for j in self.jobs.values() if j.state != 'running' ])
+        return stats
+
+    def _push(self, job):
+        """
+        Add the job to the queue
+        """
+        self.counter += 1
+        heapq.heappush(self.queue, (job.priority, self.counter, job))
+
+    def _schedule(self):
+        """
+        Start the next jobs from the queue
+        """
+        while self.running < config.download_max and self.queue:
+            priority, counter, job = heapq.heappop(self.queue)
+            if job.state != 'queued' or job.priority != priority or \
+                    self.jobs.get(job.filename) is not job:
+                # outdated entry
+                continue
+            if not job.alive:
+                # all widgets waiting for the file are gone
+                self.stats['cancelled'] += 1
+                self._done(job, False)
+                continue
+            job.state = 'running'
+            job.attempts += 1
+            self.running += 1
+            thread = threading.Thread(target=self._download, args=(job,), name='candy-download')
+            thread.daemon = True
+            thread.start()
+
+    def _retry(self, job):
+        """
+        Add the job to the queue again after the backoff delay
+        """
+        job.timer = None
+        job.state = 'queued'
+        self._push(job)
+        self._schedule()
+
+    def _done(self, job, changed):
+        """
+        Remove the job and notify the widgets
+        """
+        del self.jobs[job.filename]
+        job.inprogress.finish(changed)
+
+    @kaa.threaded(kaa.MAINTHREAD)
+    def _finished(self, job, result):
+        """
+        Handle the result of the download
+        """
+        self.running -= 1
+        if isinstance(result, Exception):
+            if getattr(result, 'retry', True) and job.attempts <= config.download_retries:
+                self.stats['retried'] += 1
+                delay = config.download_backoff * 2 ** (job.attempts - 1)
+                log.warning('unable to download %s: %s, retry in %s sec', job.url, result, delay)
+                job.state = 'backoff'
+                job.timer = kaa.OneShotTimer(self._retry, job)
+                job.timer.start(delay)
+            else:
+                log.error('unable to download %s: %s', job.url, result)
+                self.stats['failed'] += 1
+                self._done(job, False)
+        else:
+            self.stats['downloaded' if result else 'not_modified'] += 1
+            self._done(job, result)
+        self._schedule()
+
+    def _download(self, job):
+        """
+        Download the file
+        Executed in a worker thread
+        """
+        try:
+            result = self._request(job)
+        except Exception, e:
+            result = e
+        self._finished(job, result)
+
+    def _connect(self, scheme, host):
+        """
+        Return an idle connection to the host or a new one and True
+        if the connection was used before.
+        Executed in a worker thread
+        """
+        self.lock.acquire()
+        try:
+            idle = self.connections.get((scheme, host))
+            if idle:
+                self.stats['reused'] += 1
+                return idle.pop(), True
+            self.stats['connections'] += 1
+        finally:
+            self.lock.release()
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=config.download_timeout), False
+        return httplib.HTTPConnection(host, timeout=config.download_timeout), False
+
+    def _release(self, scheme, host, connection, response):
+        """
+        Keep the connection for the next request to the host
+        Executed in a worker thread
+        """
+        if response.will_close:
+            connection.close()
+            return
+        self.lock.acquire()
+        try:
+            idle = self.connections.setdefault((scheme, host), [])
+            if len(idle) < config.download_max:
+                idle.append(connection)
+                return
+        finally:
+            self.lock.release()
+        connection.close()
+
+    def _request(self, job):
+        """
+        Send the GET request and store the response. Returns True if
+        the file was written and False if it was not modified.
+        Executed in a worker thread
+        """
+        meta = {}
+        if job.revalidate and os.path.isfile(job.filename + '.meta'):
+            try:
+                meta = cPickle.load(open(job.filename + '.meta', 'rb'))
+            except Exception, e:
+                log.error('unable to load %s.meta: %s', job.filename, e)
+        headers = { 'User-Agent': 'kaa.candy' }
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        url = job.url
+        for redirect in range(MAX_REDIRECTS):
+            scheme, host, path, query, fragment = urlparse.urlsplit(url)
+            if query:
+                path += '?' + query
+            connection, reused = self._connect(scheme, host)
+            try:
+                connection.request('GET', path or '/', headers=headers)
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error), e:
+                connection.close()
+                if not reused:
+                    raise
+                # the server closed the idle connection, try again
+                # with a new one
+                connection, reused = self._connect(scheme, host)
+                connection.request('GET', path or '/', headers=headers)
+                response = connection.getresponse()
+            try:
+                if response.status in (301, 302, 303, 307, 308):
+                    response.read()
+                    url = urlparse.urljoin(url, response.getheader('location'))
+                    continue
+                if response.status == 304:
+                    response.read()
+                    # update the modification time of the meta file
+                    self._save_meta(job.filename, meta)
+                    return False
+                if response.status != 200:
+                    response.read()
+                    raise DownloadError(response.status, response.reason)
+                tmpfile = job.filename + '.tmp'
+                size = 0
+                fd = open(tmpfile, 'wb')
+                try:
+                    while True:
+                        data = response.read(65536)
+                        if not data:
+                            break
+                        fd.write(data)
+                        size += len(data)
+                finally:
+                    fd.close()
+                os.rename(tmpfile, job.filename)
+                self._save_meta(job.filename, {
+                    'etag': response.getheader('etag'),
+                    'last_modified': response.getheader('last-modified') })
+                self.lock.acquire()
+                self.stats['bytes'] += size
+                self.lock.release()
+                return True
+            except:
+                connection.close()
+                raise
+            finally:
+                if not connection.sock is None:
+                    self._release(scheme, host, connection, response)
+        raise DownloadError(310, 'Too many redirects')
+
+    def _save_meta(self, filename, meta):
+        """
+        Store the headers used to check the file for updates
+        Executed in a worker thread
+        """
+        try:
+            cPickle.dump(meta, open(filename + '.meta', 'wb'), cPickle.HIGHEST_PROTOCOL)
+        except Exception, e:
+            log.error('unable to save %s.meta: %s', filename, e)
+
+# global download manager
+_manager = DownloadManager()
+
+fetch = _manager.fetch
+set_priority = _manager.set_priority
+expired = _manager.expired
+get_stats = _manager.get_stats
+
+kaa.main.signals['shutdown'].connect(_manager.close)
@@ -0,0 +1,218 @@
+# -*- coding: iso-8859-1 -*-
+# -----------------------------------------------------------------------------
+# imageinfo.py - Image geometry from file headers
+# -----------------------------------------------------------------------------
+# The Image widget needs the size of an image before it is loaded by
+# the backend. This module reads it from the header of JPEG, PNG, GIF,
+# WebP and BMP files without decoding the image. The results are kept
+# in a bounded cache keyed by filename, file size and modification
+# time. If config.imageinfo_store is set, the cache is also saved to
+# that file and loaded again on the next start.
+#
+# -----------------------------------------------------------------------------
+# kaa-candy - Fourth generation Canvas System using Clutter as backend
+# Copyright (C) 2013 Dirk Meyer
+#
+# First Version: Dirk Meyer <https://github.com/Dischi>
+# Maintainer:    Dirk Meyer <https://github.com/Dischi>
+#
+# Based on various previous attempts to create a canvas system for
+# Freevo by Dirk Meyer and Jason Tackaberry.  Please see the file
+# AUTHORS for a complete list of authors.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MER-
+# CHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+# -----------------------------------------------------------------------------
+
+__all__ = [ 'get_geometry', 'probe', 'get_stats' ]
+
+# python imports
+import os
+import struct
+import logging
+import cPickle
+
+# kaa imports
+import kaa
+
+# kaa.candy imports
+import config
+from core import LRUCache
+
+# get logging object
+log = logging.getLogger('kaa.candy')
+
+# JPEG start of frame markers with the image size
+JPEG_SOF = range(0xc0, 0xd0)
+for marker in (0xc4, 0xc8, 0xcc):
+    JPEG_SOF.remove(marker)
+
+# cache of (width, height, format) or False; created on first use
+_cache = None
+_save_timer = None
+
+def _probe_jpeg(fd):
+    fd.seek(2)
+    app = fd.read(4)
+    while len(app) == 4:
+        ff, segtype, seglen = struct.unpack('>BBH', app)
+        if ff != 0xff or segtype == 0xd9:
+            break
+        if segtype in JPEG_SOF:
+            height, width = struct.unpack('>BHH', fd.read(5))[1:]
+            return width, height
+        fd.seek(seglen - 2, 1)
+        app = fd.read(4)
+    return None
+
+def _probe_png(fd):
+    fd.seek(8)
+    while True:
+        header = fd.read(8)
+        if len(header) < 8:
+            return None
+        seglen, segtype = struct.unpack('>I4s', header)
+        if segtype == 'IEND':
+            return None
+        if segtype == 'IHDR':
+            return struct.unpack('>II', fd.read(8))
+        fd.seek(seglen + 4, 1)
+
+def _probe_gif(fd):
+    fd.seek(6)
+    return struct.unpack('<HH', fd.read(4))
+
+def _probe_bmp(fd):
+    fd.seek(14)
+    headersize = struct.unpack('<I', fd.read(4))[0]
+    if headersize == 12:
+        # OS/2 bitmap
+        return struct.unpack('<HH', fd.read(4))
+    width, height = struct.unpack('<ii', fd.read(8))
+    # negative height for top-down bitmaps
+    return width, abs(height)
+
+def _probe_webp(fd):
+    fd.seek(12)
+    chunk = fd.read(4)
+    if chunk == 'VP8 ':
+        # lossy: frame header after the key frame start code
+        fd.seek(26)
+        width, height = struct.unpack('<HH', fd.read(4))
+        return width & 0x3fff, height & 0x3fff
+    if chunk == 'VP8L':
+        # lossless: 14 bit width and height minus one
+        fd.seek(21)
+        bits = struct.unpack('<I', fd.read(4))[0]
+        return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    if chunk == 'VP8X':
+        # extended: 24 bit canvas width and height minus one
+        fd.seek(24)
+        data = fd.read(6)
+        width = struct.unpack('<I', data[:3] + '\0')[0]
+        height = struct.unpack('<I', data[3:] + '\0')[0]
+        return width + 1, height + 1
+    return None
+
+def probe(filename):
+    """
+    Read the geometry from the file header. Returns (width, height,
+    format) or None if the format is not supported.
+    """
+    fd = open(filename, 'rb')
+    try:
+        magic = fd.read(16)
+        if magic[:2] == '\xff\xd8':
+            result, format = _probe_jpeg(fd), 'jpeg'
+        elif magic[:8] == '\211PNG\r\n\032\n':
+            result, format = _probe_png(fd), 'png'
+        elif magic[:6] in ('GIF87a', 'GIF89a'):
+            result, format = _probe_gif(fd), 'gif'
+        elif magic[:2] == 'BM':
+            result, format = _probe_bmp(fd), 'bmp'
+        elif magic[:4] == 'RIFF' and magic[8:12] == 'WEBP':
+            result, format = _probe_webp(fd), 'webp'
+        else:
+            return None
+    except struct.error:
+        # file too short
+        return None
+    finally:
+        fd.close()
+    if not result or result[0] <= 0 or result[1] <= 0:
+        return None
+    return result[0], result[1], format
+
+def _load():
+    """
+    Create the cache and load the stored entries
+    """
+    global _cache
+    _cache = LRUCache(config.imageinfo_cache)
+    if not config.imageinfo_store:
+        return
+    kaa.main.signals['shutdown'].connect(_save)
+    if not os.path.isfile(config.imageinfo_store):
+        return
+    try:
+        for key, value in cPickle.load(open(config.imageinfo_store, 'rb')):
+            _cache[key] = value
+    except Exception, e:
+        log.error('unable to load %s: %s', config.imageinfo_store, e)
+
+def _save():
+    """
+    Write the cache to config.imageinfo_store
+    """
+    if not config.imageinfo_store or _cache is None:
+        return
+    try:
+        tmpfile = config.imageinfo_store + '.tmp'
+        cPickle.dump(_cache.items(), open(tmpfile, 'wb'), cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmpfile, config.imageinfo_store)
+    except Exception, e:
+        log.error('unable to save %s: %s', config.imageinfo_store, e)
+
+def get_geometry(filename):
+    """
+    Return (width, height, format) for the image file or None if the
+    format is not supported.
+    """
+    global _save_timer
+    if _cache is None:
+        _load()
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    key = filename, stat.st_size, stat.st_mtime
+    # unsupported files are stored as False
+    info = _cache.get(key)
+    if info is None:
+        info = _cache[key] = probe(filename) or False
+        if config.imageinfo_store:
+            if _save_timer is None:
+                _save_timer = kaa.OneShotTimer(_save)
+            if not _save_timer.active:
+                _save_timer.start(10)
+    return info or None
+
+def get_stats():
+    """
+    Return hits and misses of the cache
+    """
+    if _cache is None:
+        return { 'hits': 0, 'misses': 0, 'entries': 0 }
+    return { 'hits': _cache.hits, 'misses': _cache.misses, 'entries': len(_cache) }
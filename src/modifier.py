@@ -112,11 +112,11 @@ class Properties(dict, Modifier):
         for key, value in element.attributes():
             if key in ('opacity', 'depth', 'scale_x', 'scale_y'):
                 value = int(value)
-            elif key in ('rotation','xrotation','yrotation','zrotation'):
+            elif key in ('rotation','xrotation','yrotation','zrotation', 'crossfade'):
                 value = float(value)
             elif key in ('xalign', 'yalign'):
                 value = value.lower()
-            elif key in ('keep_aspect',):
+            elif key in ('keep_aspect', 'progressive'):
                 value = value.lower() in ('yes', 'true')
             elif key in ('anchor_point', ):
                 value = [ int(x) for x in value.split(',') ]
@@ -0,0 +1,160 @@
+# -*- coding: iso-8859-1 -*-
+# -----------------------------------------------------------------------------
+# ringbuffer.py - Shared memory ring buffer for position updates
+# -----------------------------------------------------------------------------
+# Note: this file is imported from the application using kaa.candy as
+# well as the rendering process. Therefore, no imports from this file
+# to other parts of kaa.candy are allowed to avoid strange side
+# effects.
+#
+# Syncs only moving existing widgets (e.g. scrolling a grid) do not
+# need the rpc round trip. The stage writes fixed-size records into a
+# file in /dev/shm mapped by both processes and the clutter thread in
+# the backend reads them on each frame. The header contains two
+# counters: the number of records written by the application and the
+# number of records read by the backend. There is only one writer and
+# one reader, each counter is only changed by one side.
+#
+# -----------------------------------------------------------------------------
+# kaa-candy - Fourth generation Canvas System using Clutter as backend
+# Copyright (C) 2013 Dirk Meyer
+#
+# First Version: Dirk Meyer <https://github.com/Dischi>
+# Maintainer:    Dirk Meyer <https://github.com/Dischi>
+#
+# Based on various previous attempts to create a canvas system for
+# Freevo by Dirk Meyer and Jason Tackaberry.  Please see the file
+# AUTHORS for a complete list of authors.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MER-
+# CHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+# -----------------------------------------------------------------------------
+
+__all__ = [ 'PositionRing' ]
+
+# python imports
+import os
+import mmap
+import struct
+import tempfile
+
+# flags for the record fields
+POSITION = 1
+OPACITY = 2
+SCALE = 4
+ANIMATE = 8
+
+# clutter animation modes supported by the ring buffer; other modes
+# must use the rpc
+ANIMATION_MODES = [
+    'LINEAR', 'EASE_IN_QUAD', 'EASE_OUT_QUAD', 'EASE_IN_OUT_QUAD',
+    'EASE_IN_CUBIC', 'EASE_OUT_CUBIC', 'EASE_IN_OUT_CUBIC',
+    'EASE_IN_QUART', 'EASE_OUT_QUART', 'EASE_IN_OUT_QUART',
+    'EASE_IN_QUINT', 'EASE_OUT_QUINT', 'EASE_IN_OUT_QUINT',
+    'EASE_IN_SINE', 'EASE_OUT_SINE', 'EASE_IN_OUT_SINE',
+    'EASE_IN_EXPO', 'EASE_OUT_EXPO', 'EASE_IN_OUT_EXPO',
+    'EASE_IN_CIRC', 'EASE_OUT_CIRC', 'EASE_IN_OUT_CIRC',
+    'EASE_IN_ELASTIC', 'EASE_OUT_ELASTIC', 'EASE_IN_OUT_ELASTIC',
+    'EASE_IN_BACK', 'EASE_OUT_BACK', 'EASE_IN_OUT_BACK',
+    'EASE_IN_BOUNCE', 'EASE_OUT_BOUNCE', 'EASE_IN_OUT_BOUNCE'
+]
+
+# header: written, read
+HEADER = struct.Struct('<II')
+HEADER_SIZE = 64
+
+# record: sync sequence, widget id, flags, animation mode, x, y,
+# opacity, scale_x, scale_y, animation duration in ms
+RECORD = struct.Struct('<IiHHiiiffI')
+
+class PositionRing(object):
+    """
+    Ring buffer of position, opacity and scale records
+    """
+    def __init__(self, filename, slots=None):
+        """
+        Map the ring buffer in filename. If slots is given, the file
+        is created with that number of records.
+        """
+        self.filename = filename
+        fd = os.open(filename, os.O_RDWR)
+        try:
+            if slots:
+                os.ftruncate(fd, HEADER_SIZE + slots * RECORD.size)
+            size = os.fstat(fd).st_size
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.slots = (size - HEADER_SIZE) / RECORD.size
+
+    @classmethod
+    def create(cls, slots):
+        """
+        Create a new ring buffer in shared memory. The number of
+        slots is rounded up to a power of two to keep the counters
+        valid when they wrap around.
+        """
+        slots = 1 << (slots - 1).bit_length()
+        fd, filename = tempfile.mkstemp(prefix='candy-ring', dir='/dev/shm')
+        os.close(fd)
+        return cls(filename, slots)
+
+    def unlink(self):
+        """
+        Remove the file, the mapping stays valid
+        """
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
+
+    def close(self):
+        """
+        Close the mapping
+        """
+        self.map.close()
+
+    def space(self):
+        """
+        Return the number of free records
+        """
+        written, read = HEADER.unpack_from(self.map, 0)
+        return self.slots - ((written - read) & 0xffffffff)
+
+    def write(self, seq, wid, flags, mode=0, x=0, y=0, opacity=0, scale_x=1.0,
+              scale_y=1.0, duration=0):
+        """
+        Add one record. Returns False if the ring buffer is full.
+        """
+        written, read = HEADER.unpack_from(self.map, 0)
+        if ((written - read) & 0xffffffff) >= self.slots:
+            return False
+        offset = HEADER_SIZE + (written % self.slots) * RECORD.size
+        RECORD.pack_into(self.map, offset, seq, wid, flags, mode, x, y, opacity,
+                         scale_x, scale_y, duration)
+        # the record must be written before the counter is changed
+        struct.pack_into('<I', self.map, 0, (written + 1) & 0xffffffff)
+        return True
+
+    def read(self):
+        """
+        Return all records written since the last call
+        """
+        written, read = HEADER.unpack_from(self.map, 0)
+        records = []
+        while read != written:
+            offset = HEADER_SIZE + (read % self.slots) * RECORD.size
+            records.append(RECORD.unpack_from(self.map, offset))
+            read = (read + 1) & 0xffffffff
+        struct.pack_into('<I', self.map, 4, read)
+        return records
@@ -43,8 +43,11 @@ import kaa.rpc
 
 # kaa.candy imports
 from widgets import Group, Widget, POSSIBLE_PLAYER
+from core import OrderedSet
 
 import candyxml
+import config
+import ringbuffer
 
 # get logging object
 log = logging.getLogger('kaa.candy')
@@ -98,6 +101,11 @@ class Stage(kaa.Object):
 
     active = True
 
+    _ring = None
+
+    # number of widgets visited and changed in the last sync
+    sync_stats = {}
+
     def __init__(self, size, name, logfile='', fullscreen=False):
         super(Stage, self).__init__()
         self.name = 'candy-backend-%s' % name
@@ -145,6 +153,17 @@ class Stage(kaa.Object):
         self.backend_state = Stage.BACKEND_INITIALIZING
         self.commands = []
         self.tasks = []
+        # number of sync calls, the ring buffer records refer to it
+        # to be applied after the last rpc sync
+        self._sync_seq = 0
+        # last sync the backend acknowledged
+        self._sync_acked = 0
+        if self._ring:
+            self._ring.unlink()
+            self._ring.close()
+            self._ring = None
+        if config.shm_transport:
+            self._ring = ringbuffer.PositionRing.create(config.shm_slots)
         os.write(self._render_pipe[1], '1')
 
     def __reset__(self):
@@ -174,11 +193,13 @@ class Stage(kaa.Object):
         # start the backend again
         yield self._start_backend()
         # reset widget status
-        Widget._candy_sync_new = []
-        Widget._candy_sync_reparent = []
+        Widget._candy_sync_new = OrderedSet()
+        Widget._candy_sync_reparent = OrderedSet()
         Widget._candy_sync_delete = []
-        for widget in Widget._candy_all_widgets:
-            widget.__reset__()
+        for wid, widget in sorted(Widget._candy_widget_index.items()):
+            widget = widget()
+            if widget is not None:
+                widget.__reset__()
         self.__sync()
 
     def add_layer(self, layer=None, sibling=None):
@@ -252,7 +273,7 @@ class Stage(kaa.Object):
         application is busy somehow.
         """
         if state != self.active:
-            self.ipc.rpc('sync', [('active', (state, ))])
+            self._send_tasks([('active', (state, ))])
             self.active = state
             if state and self.tasks:
                 # some queued tasks, rerun sync
@@ -266,6 +287,12 @@ class Stage(kaa.Object):
             self._candy_dirty = True
             os.write(self._render_pipe[1], '1')
 
+    def _candy_queue_child(self, child, layout=False):
+        """
+        Queue sync for a layer
+        """
+        self.queue_rendering()
+
     def queue_command(self, candy_id, cmd, args):
         """
         Queue sync for a command
@@ -296,7 +323,7 @@ class Stage(kaa.Object):
             tasks.append(('import', module))
         if tasks:
             # make sure everything is imported before we need it
-            self.ipc.rpc('sync', tasks)
+            self._send_tasks(tasks)
             tasks = []
         # prepare all widgets for the sync
         for layer in self.layer:
@@ -307,7 +334,7 @@ class Stage(kaa.Object):
         # re-arrange the calls later.
         new_widgets = []
         while Widget._candy_sync_new:
-            widget = Widget._candy_sync_new.pop(0)
+            widget = Widget._candy_sync_new.pop()
             widget.stage = self
             widget.backend.stage = self
             while widget.backend.queue:
@@ -317,20 +344,32 @@ class Stage(kaa.Object):
         # create stage object if needed
         if self.backend_state == Stage.BACKEND_INITIALIZING:
             self.backend_state = Stage.BACKEND_RUNNING
+            tasks.append(('configure', ({
+                'frame_rate': config.frame_rate, 'frame_budget': config.frame_budget,
+                'decoder_threads': config.decoder_threads,
+                'decoder_queue': config.decoder_queue,
+                'texture_cache': config.texture_cache,
+                'atlas_image_size': config.atlas_image_size,
+                'atlas_size': config.atlas_size, 'atlas_count': config.atlas_count,
+                'text_threads': config.text_threads, 'text_cache': config.text_cache,
+                'text_glyph_cache': config.text_glyph_cache },)))
             tasks.append(('add', ('stage.Stage', -1)))
             tasks.append(('call', (-1, 'init', (self.size, self.fullscreen))))
+            if self._ring:
+                tasks.append(('ring', (self._ring.filename,)))
         # Change parents for the widgets. Remember the needed calls in
         # a seperate variable. We need to reparent before updaing
         # everything here, but maybe do it later on the backend.
         tasks_reparent = []
         while Widget._candy_sync_reparent:
-            widget = Widget._candy_sync_reparent.pop(0)
+            widget = Widget._candy_sync_reparent.pop()
             if widget.parent:
                 tasks_reparent.append(('reparent', (widget._candy_id, widget.parent._candy_id, widget._candy_stack)))
             else:
                 tasks_reparent.append(('reparent', (widget._candy_id, None, None)))
         # sync all children
         tasks_update = []
+        Widget._candy_sync_stats.update(visited=0, changed=0, layout=0, layout_cached=0)
         for layer in self.layer[:]:
             if layer._state == Layer.STATUS_NEW:
                 tasks.append(('reparent', (layer._candy_id, -1, None)))
@@ -340,6 +379,10 @@ class Stage(kaa.Object):
                 self.layer.remove(layer)
             else:
                 layer.__sync__(tasks_update)
+        self.sync_stats = dict(Widget._candy_sync_stats)
+        if config.performance_debug:
+            log.info('sync: %(visited)s widgets visited, %(changed)s changed, '
+                     '%(layout)s layouts calculated, %(layout_cached)s cached', self.sync_stats)
         # Now the tricky part. All create, update and move functions
         # are called in the clutter thread at the backend. If it takes
         # too long, running animations may look strange. But for new
@@ -355,14 +398,22 @@ class Stage(kaa.Object):
             if t[0] == 'update' and t[1][0] in new_widgets:
                 tasks.append(t)
                 tasks_update.remove(t)
+        if self._ring and self.active and not tasks and not tasks_reparent and \
+                not self.tasks and not Widget._candy_sync_delete and \
+                self._send_ring(tasks_update):
+            # Only existing widgets are moved, everything is in the
+            # ring buffer now.
+            return
         self.tasks = self.tasks + tasks + [('freeze', None)] + tasks_reparent + tasks_update
         # add commands for the widgets
         while self.commands:
             self.tasks.append(('call', self.commands.pop(0)))
         while Widget._candy_sync_delete:
             self.tasks.append(('delete', (Widget._candy_sync_delete.pop(0),)))
-        # now send everything to the backend
-        if self.tasks and self.active:
+        # now send everything to the backend unless too many syncs
+        # are still in progress; event_sync_done will continue then.
+        if self.tasks and self.active and \
+                self._sync_seq - self._sync_acked < config.sync_max_pending:
             if DEBUG:
                 print 'sync'
                 for t in self.tasks:
@@ -370,11 +421,87 @@ class Stage(kaa.Object):
                 print
             try:
                 if self.ipc:
-                    self.ipc.rpc('sync', self.tasks)
+                    self._send_tasks(self.tasks)
                 self.tasks = []
             except kaa.rpc.NotConnectedError, e:
                 self._ipc_disconnect()
 
+    def _send_tasks(self, tasks):
+        """
+        Send the tasks to the backend
+        """
+        self._sync_seq += 1
+        self.ipc.rpc('sync', tasks, self._sync_seq)
+
+    def _send_ring(self, tasks):
+        """
+        Write the tasks and queued commands into the ring buffer if
+        all of them are position, opacity, scale or animation changes
+        of existing widgets. Returns False if the rpc must be used.
+        """
+        records = []
+        for cmd, args in tasks:
+            if cmd == 'position':
+                wid, x, y = args
+                if type(x) is not int or type(y) is not int:
+                    return False
+                records.append((wid, ringbuffer.POSITION, 0, x, y))
+            elif cmd == 'update':
+                record = self._ring_record(args[0], None, 0, args[1])
+                if not record:
+                    return False
+                records.append(record)
+            else:
+                return False
+        for wid, cmd, args in self.commands:
+            if cmd != 'animate' or len(args) < 2 or len(args) % 2:
+                return False
+            ease, secs = args[:2]
+            attributes = dict(zip(args[2::2], args[3::2]))
+            record = self._ring_record(wid, ease, secs, attributes)
+            if not record:
+                return False
+            records.append(record)
+        if not records or len(records) > self._ring.space():
+            return False
+        for record in records:
+            self._ring.write(self._sync_seq, *record)
+        self.commands = []
+        return True
+
+    def _ring_record(self, wid, ease, secs, attributes):
+        """
+        Create a ring buffer record for changing the given attributes.
+        Returns None if that is not possible.
+        """
+        flags = mode = 0
+        x = y = opacity = 0
+        scale_x = scale_y = 1.0
+        attributes = attributes.copy()
+        if ease is not None:
+            if not ease in ringbuffer.ANIMATION_MODES:
+                return None
+            flags |= ringbuffer.ANIMATE
+            mode = ringbuffer.ANIMATION_MODES.index(ease)
+        if 'x' in attributes or 'y' in attributes:
+            x, y = attributes.pop('x', None), attributes.pop('y', None)
+            if type(x) is not int or type(y) is not int:
+                return None
+            flags |= ringbuffer.POSITION
+        if 'opacity' in attributes:
+            opacity = attributes.pop('opacity')
+            if type(opacity) is not int:
+                return None
+            flags |= ringbuffer.OPACITY
+        if 'scale_x' in attributes or 'scale_y' in attributes:
+            scale_x, scale_y = attributes.pop('scale_x', None), attributes.pop('scale_y', None)
+            if not isinstance(scale_x, (int, float)) or not isinstance(scale_y, (int, float)):
+                return None
+            flags |= ringbuffer.SCALE
+        if attributes or not flags:
+            return None
+        return wid, flags, mode, x, y, opacity, scale_x, scale_y, int(secs * 1000) or 1
+
     def set_content_geometry(self, size):
         """
         Set the geometry. This will scale the group in the stage
@@ -386,6 +513,13 @@ class Stage(kaa.Object):
         for layer in self.layer:
             (layer.scale_x, layer.scale_y), (layer.width, layer.height) = self.scale
 
+    def get_stats(self):
+        """
+        Get statistics from the backend, e.g. the frame timing of
+        the sync. Returns an InProgress object.
+        """
+        return self.ipc.rpc('stats')
+
     @kaa.rpc.expose()
     def event_key_press(self, key):
         """
@@ -394,6 +528,16 @@ class Stage(kaa.Object):
         if self.active:
             self.signals['key-press'].emit(key)
 
+    @kaa.rpc.expose()
+    def event_sync_done(self, seq):
+        """
+        Callback from the backend when a sync is applied
+        """
+        self._sync_acked = seq
+        if self.tasks:
+            # changes waiting for the backend
+            os.write(self._render_pipe[1], '1')
+
     @kaa.rpc.expose()
     def event_widget_call(self, wid, func, *args, **kwargs):
         """
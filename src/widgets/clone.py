@@ -51,6 +51,8 @@ class Clone(Widget):
         super(Clone, self).__init__(pos, None, context={})
         self.master = master
         self.__candy_set_master = True
+        # the size depends on the master
+        master.add_layout_dependent(self)
 
     def sync_layout(self, size):
         """
@@ -30,11 +30,15 @@
 
 __all__ = [ 'Grid', 'SelectionGrid' ]
 
+# python imports
+import time
+
 # kaa imports
 import kaa
 
 # kaa.candy imports
-from .. import is_template
+from .. import is_template, config
+from widget import Widget
 from group import AbstractGroup
 
 class Grid(AbstractGroup):
@@ -50,7 +54,8 @@ class Grid(AbstractGroup):
     __items = None
 
     def __init__(self, pos, size, cell_size, cell_item, items, template,
-                 orientation, xpadding=None, ypadding=None, context=None):
+                 orientation, xpadding=None, ypadding=None, context=None, virtual=False,
+                 prefetch=0):
         """
         Simple grid widget to show the items based on the template.
 
@@ -66,6 +71,10 @@ class Grid(AbstractGroup):
         @param ypadding: y value of space between two items. If set to None
             the padding will be calculated based on cell size and widget size
         @param context: the context the widget is created in
+        @param virtual: only keep cells around the visible area and reuse
+            cells scrolled out of it for new items
+        @param prefetch: number of rows or columns to create ahead in
+            scroll direction after scrolling
         """
         super(Grid, self).__init__(pos, size, context=context)
         # store arguments for later public use
@@ -79,6 +88,18 @@ class Grid(AbstractGroup):
         self.cell_item = cell_item
         self.template = template
         self.item_padding = xpadding, ypadding
+        self.virtual = virtual
+        # cells not used in a virtual grid
+        self.__pool = []
+        # cells created ahead of scrolling. A hit is a cell becoming
+        # visible after it was prefetched, a miss a cell created when
+        # it had to be visible.
+        self.prefetch = prefetch
+        self.prefetch_stats = { 'hit': 0, 'miss': 0 }
+        self.__prefetched = set()
+        self.__prefetch_timer = kaa.WeakOneShotTimer(self.__prefetch_cells)
+        self.__scroll_step = 0
+        self.__scroll_time = 0
 
     def create_grid(self):
         """
@@ -116,6 +137,8 @@ class Grid(AbstractGroup):
         self.clip = (x0 - padding_x, y0 - padding_y), \
             (self.num_items_x * self.item_width + padding_x, self.num_items_y * self.item_height + padding_y)
         self.location = (0, 0)
+        self.__location_synced = self.__location_counted = (0, 0)
+        self.__location_prioritized = None
         # list of rendered items
         self.item_widgets = {}
         # group of items
@@ -135,20 +158,158 @@ class Grid(AbstractGroup):
         child_y = pos_y * self.item_height
         context = self.context.copy()
         context[self.cell_item] = self.items[item_num]
-        child = self.template(context=context)
+        child = None
+        if self.__pool:
+            child = self.__pool.pop()
+            if child.supports_context(context):
+                # reuse a cell scrolled out of the visible area
+                child.context = context
+                if child.priority != Widget.PRIORITY_NORMAL:
+                    child.set_priority(Widget.PRIORITY_NORMAL)
+            else:
+                child.parent = None
+                child = None
+        if child is None:
+            child = self.template(context=context)
+            self.item_group.add(child)
         child.x = child_x
         child.y = child_y
         child.width, child.height = self.cell_size
-        self.item_group.add(child)
         self.item_widgets[(pos_x, pos_y)] = child
         return child
 
+    def get_item_num(self, pos_x, pos_y):
+        """
+        Return the index in the items for the cell
+        """
+        if self.__orientation == Grid.VERTICAL:
+            return pos_x + pos_y * self.num_items_x
+        return pos_x * self.num_items_y + pos_y
+
+    def __cells(self, (loc_x, loc_y), margin=0):
+        """
+        Return the cells of the visible area for the location plus
+        the given number of rows or columns in scroll direction
+        """
+        margin_x = margin_y = margin
+        # the margin is only needed in scroll direction
+        if self.__orientation == Grid.VERTICAL:
+            margin_x = 0
+        else:
+            margin_y = 0
+        cols = range(max(0, loc_x - margin_x), loc_x + self.num_items_x + margin_x)
+        rows = range(max(0, loc_y - margin_y), loc_y + self.num_items_y + margin_y)
+        return set([ (x, y) for x in cols for y in rows ])
+
+    def __sync_virtual(self):
+        """
+        Create the cells for a virtual grid. Cells outside the area
+        visible before and after the last scrolling are moved to the
+        pool and reused for new cells.
+        """
+        margin = config.grid_virtual_margin
+        cells = self.__cells(self.location, margin)
+        # cells of the old location are still visible while the
+        # scroll animation is running
+        cells.update(self.__cells(self.__location_synced, margin))
+        cells.update(self.__prefetched)
+        self.__location_synced = self.location
+        for pos in self.item_widgets.keys():
+            if not pos in cells:
+                child = self.item_widgets.pop(pos)
+                if child is not None:
+                    child.set_priority(Widget.PRIORITY_LOW)
+                    self.__pool.append(child)
+        for x, y in sorted(cells):
+            if not (x, y) in self.item_widgets:
+                self.create_item(self.get_item_num(x, y), x, y)
+        # cells in the pool keep their old position outside the clip
+        # area; destroy the cells exceeding the pool size
+        while len(self.__pool) > config.grid_virtual_pool:
+            self.__pool.pop(0).parent = None
+
+    def __sync_prefetch_stats(self):
+        """
+        Count the visible cells created by prefetching and the cells
+        still missing after scrolling.
+        """
+        if self.__location_counted == self.location:
+            return
+        self.__location_counted = self.location
+        for x, y in self.__cells(self.location):
+            if not 0 <= self.get_item_num(x, y) < len(self.items):
+                continue
+            if (x, y) in self.__prefetched:
+                self.__prefetched.remove((x, y))
+                self.prefetch_stats['hit'] += 1
+            elif not (x, y) in self.item_widgets:
+                self.prefetch_stats['miss'] += 1
+
+    def __sync_priority(self):
+        """
+        Load the content of the visible cells first. Cells scrolled
+        out of the visible area get a lower priority.
+        """
+        if self.__location_prioritized == self.location:
+            return
+        cells = self.__cells(self.location)
+        if self.__location_prioritized is not None:
+            for pos in self.__cells(self.__location_prioritized) - cells:
+                child = self.item_widgets.get(pos)
+                if child is not None:
+                    child.set_priority(Widget.PRIORITY_LOW)
+        self.__location_prioritized = self.location
+        for pos in cells:
+            child = self.item_widgets.get(pos)
+            if child is not None and child.priority != Widget.PRIORITY_NORMAL:
+                child.set_priority(Widget.PRIORITY_NORMAL)
+
+    def __prefetch_cells(self):
+        """
+        Create the cells for the next rows or columns in scroll
+        direction. The number depends on the prefetch depth and the
+        scroll speed.
+        """
+        if not self.__scroll_step or self.create_grid:
+            return
+        loc_x, loc_y = self.location
+        if self.__orientation == Grid.VERTICAL:
+            visible = self.num_items_y
+        else:
+            visible = self.num_items_x
+        # scale with the number of rows or columns per scroll step
+        depth = min(self.prefetch * abs(self.__scroll_step), visible * 2)
+        if self.__scroll_step > 0:
+            lines = range(visible, visible + depth)
+        else:
+            lines = range(-depth, 0)
+        cells = set()
+        for line in lines:
+            if self.__orientation == Grid.VERTICAL:
+                cells.update([ (x, loc_y + line) for x in range(self.num_items_x) ])
+            else:
+                cells.update([ (loc_x + line, y) for y in range(self.num_items_y) ])
+        # forget cells prefetched for the old location; a virtual
+        # grid moves them into the pool on the next sync
+        self.__prefetched.intersection_update(cells)
+        for x, y in sorted(cells):
+            if x < 0 or y < 0 or (x, y) in self.item_widgets:
+                continue
+            item_num = self.get_item_num(x, y)
+            if 0 <= item_num < len(self.items):
+                child = self.create_item(item_num, x, y)
+                # content of visible cells is loaded first
+                child.set_priority(Widget.PRIORITY_LOW)
+                self.__prefetched.add((x, y))
+
     def clear(self):
         """
         Clear the grid
         """
         self.item_group.clear()
         self.item_widgets = {}
+        self.__pool = []
+        self.__prefetched = set()
         self.queue_rendering()
 
     def sync_prepare(self):
@@ -159,6 +320,12 @@ class Grid(AbstractGroup):
             self.create_grid()
         if not super(Grid, self).sync_prepare():
             return False
+        if self.prefetch:
+            self.__sync_prefetch_stats()
+        if self.virtual:
+            self.__sync_virtual()
+            self.__sync_priority()
+            return super(Grid, self).sync_prepare()
         if self.__orientation == Grid.VERTICAL:
             max_x, max_y = self.location
             for y in range(0, max_y + self.num_items_y):
@@ -173,6 +340,7 @@ class Grid(AbstractGroup):
                     item_num = x * self.num_items_y + y
                     if not (x, y) in self.item_widgets:
                         self.create_item(item_num, x, y)
+        self.__sync_priority()
         return super(Grid, self).sync_prepare()
 
     def sync_context(self):
@@ -248,6 +416,19 @@ class Grid(AbstractGroup):
         """
         if self.create_grid:
             self.create_grid()
+        if self.__orientation == Grid.VERTICAL:
+            step = y - self.location[1]
+        else:
+            step = x - self.location[0]
+        if step and self.prefetch:
+            now = time.time()
+            if (step > 0) == (self.__scroll_step > 0) and now - self.__scroll_time < 0.5:
+                # the user keeps scrolling in the same direction,
+                # prefetch twice as much
+                step *= 2
+            self.__scroll_step, self.__scroll_time = step, now
+            # create the next cells when the animation is running
+            self.__prefetch_timer.start(1.0 / config.frame_rate)
         self.location = (x, y)
         pos_x = -x * self.item_width + self.clip[0][0] + self.item_padding[0]
         pos_y = -y * self.item_height + self.clip[0][1] + self.item_padding[1]
@@ -264,6 +445,9 @@ class Grid(AbstractGroup):
           </grid>
         There is only one child element allowed, if more is needed you need
         to add a container as child with the real children in it.
+        Set virtual='yes' to reuse cells while scrolling through long
+        lists of items and prefetch='1' to create the next row or column
+        ahead of scrolling.
         """
         subelement = element[0]
         orientation = Grid.HORIZONTAL
@@ -273,10 +457,11 @@ class Grid(AbstractGroup):
             element.cell_width = int(element.cell_width)
         if element.cell_height:
             element.cell_height = int(element.cell_height)
+        virtual = (element.virtual or '').lower() in ('yes', 'true')
         return super(Grid, cls).candyxml_parse(element).update(
             template=subelement.xmlcreate(), items=element.items,
             cell_size=(element.cell_width, element.cell_height), cell_item=element.cell_item,
-            orientation=orientation)
+            orientation=orientation, virtual=virtual, prefetch=int(element.prefetch or 0))
 
 
 
@@ -289,7 +474,8 @@ class SelectionGrid(Grid):
     candyxml_style = 'selection'
 
     def __init__(self, pos, size, cell_size, cell_item, items, template,
-                 selection, orientation, xpadding=None, ypadding=None, context=None):
+                 selection, orientation, xpadding=None, ypadding=None, context=None,
+                 virtual=False, prefetch=0):
         """
         Simple grid widget to show the items based on the template.
 
@@ -306,10 +492,14 @@ class SelectionGrid(Grid):
         @param ypadding: y value of space between two items. If set to None
             the padding will be calculated based on cell size and widget size
         @param context: the context the widget is created in
+        @param virtual: only keep cells around the visible area and reuse
+            cells scrolled out of it for new items
+        @param prefetch: number of rows or columns to create ahead in
+            scroll direction after scrolling
 
         """
         super(SelectionGrid, self).__init__(pos, size, cell_size, cell_item, items,
-            template, orientation, xpadding, ypadding, context)
+            template, orientation, xpadding, ypadding, context, virtual, prefetch)
         if is_template(selection):
             selection = selection()
         self.selection = selection
@@ -38,6 +38,7 @@ import kaa
 
 # kaa.candy imports
 from widget import Widget
+from ..core import OrderedSet
 from .. import is_template
 
 # get logging object
@@ -57,35 +58,43 @@ class AbstractGroup(Widget):
     def __init__(self, pos=None, size=None, context=None):
         super(AbstractGroup, self).__init__(pos, size, context)
         self.children = []
+        # all children and grandchildren with a name
+        self._candy_names = {}
+        # children to visit on the next sync
+        self._candy_dirty_children = OrderedSet()
 
     def __sync__(self, tasks):
         """
         Internal function to add the changes to the list of tasks for
         the backend.
         """
-        super(AbstractGroup, self).__sync__(tasks)
-        for child in self.children:
-            child.__sync__(tasks)
+        if not super(AbstractGroup, self).__sync__(tasks):
+            return False
+        # Only children marked dirty need to be visited. A child
+        # changed by the layout calculation of a sibling is added
+        # again while we are in this loop.
+        dirty = self._candy_dirty_children
+        while dirty:
+            dirty.pop().__sync__(tasks)
         return True
 
-    def queue_rendering(self):
-        """
-        Queue sync for layout changes
-        """
-        super(AbstractGroup, self).queue_rendering()
-        # Note: changing one widget will mark all anchestors dirty to
-        # force the __sync__ method to call the widget. On the other
-        # side, marking an AbstractGroup dirty will also mark all
-        # variable sized children. Therefore, changing one widget may
-        # result in a complete re-checking all widgets on sync. This
-        # is a stupid and unneccessary task, but keeping all
-        # dependencies in account is very complex and maybe not worth
-        # it. So we mark everything dirty, no big deal. The sync
-        # method will only sync what really changed and by this we
-        # have the overhead in the main app and not the backend.
-        for child in self.children:
-            if child.variable_size and not child._candy_dirty:
-                child.queue_rendering()
+    def _candy_queue_child(self, child, layout=False):
+        """
+        Add the child to the children to visit on the next sync. If
+        layout is True, the geometry of the child changed and the
+        layout of the group must be calculated again. A child of None
+        means the list of children changed.
+        """
+        if child is not None:
+            self._candy_dirty_children.add(child)
+        if layout and not self._candy_in_layout:
+            self.intrinsic_size = None
+            # The intrinsic size of the group is the space required
+            # by the children, the parent only depends on it when
+            # shrinking the group.
+            self._candy_queue(self.xalign == Widget.ALIGN_SHRINK or self.yalign == Widget.ALIGN_SHRINK)
+        else:
+            self._candy_queue()
 
     def sync_context(self):
         """
@@ -100,6 +109,24 @@ class AbstractGroup(Widget):
             else:
                 child.context = context
 
+    def set_priority(self, priority):
+        """
+        Set the priority for loading the content of the children
+        """
+        super(AbstractGroup, self).set_priority(priority)
+        for child in self.children:
+            child.set_priority(priority)
+
+    def _candy_named(self):
+        """
+        Return a list of (name, widget) for this widget and all its
+        children with a name.
+        """
+        named = super(AbstractGroup, self)._candy_named()
+        for name, widgets in self._candy_names.items():
+            named.extend([ (name, widget) for widget in widgets ])
+        return named
+
     def sync_layout(self, size):
         """
         Sync layout changes and calculate intrinsic size based on the
@@ -107,8 +134,20 @@ class AbstractGroup(Widget):
         """
         super(AbstractGroup, self).sync_layout(size)
         children_width = children_height = 0
+        # layout before the calculation for children based on the
+        # siblings; they are checked after the second pass
+        states = {}
         for child in self.children:
-            intrinsic_size = child.sync_layout(self.size)
+            if child.reference_x == 'parent' and child.reference_y == 'parent':
+                child._candy_sync_layout(self.size)
+            elif child.reference_x != 'parent' and child.reference_y != 'parent':
+                # both values are based on the siblings, nothing to
+                # calculate before the second pass
+                states[child] = child._candy_layout_state()
+                continue
+            else:
+                states[child] = child._candy_layout_state()
+                child._candy_layout(self.size)
             if child.reference_x != 'parent':
                 # ignore this child and calculate this later when we
                 # know more about the children
@@ -137,7 +176,8 @@ class AbstractGroup(Widget):
                 continue
             width = children_width if child.reference_x != 'parent' else self.size[0]
             height = children_height if child.reference_y != 'parent' else self.size[1]
-            child.sync_layout((width, height))
+            child._candy_layout((width, height))
+            child._candy_check_layout(states[child])
 
     def sync_prepare(self):
         """
@@ -145,7 +185,7 @@ class AbstractGroup(Widget):
         """
         if not super(AbstractGroup, self).sync_prepare():
             return False
-        for child in self.children:
+        for child in list(self._candy_dirty_children):
             child.sync_prepare()
         return True
 
@@ -157,6 +197,13 @@ class AbstractGroup(Widget):
         @param name: name of the child
         @returns: widget or None
         """
+        widgets = self._candy_names.get(name)
+        if not widgets:
+            return None
+        if len(widgets) == 1:
+            return widgets[0]
+        # more than one widget with that name, search for the first
+        # one in the tree
         for child in self.children:
             if child.name == name:
                 return child
@@ -174,13 +221,16 @@ class AbstractGroup(Widget):
         @param wid: id of the child
         @returns: widget or None
         """
-        for child in self.children:
-            if child._candy_id == wid:
-                return child
-            if isinstance(child, AbstractGroup):
-                result = child.get_widget_by_id(wid)
-                if result is not None:
-                    return result
+        widget = Widget._candy_widget_index.get(wid)
+        if widget is None or widget() is None:
+            return None
+        widget = widget()
+        # check if the widget is part of this group
+        parent = widget.parent
+        while isinstance(parent, AbstractGroup):
+            if parent == self:
+                return widget
+            parent = parent.parent
         return None
 
     def add(self, *widgets):
@@ -205,14 +255,15 @@ class AbstractGroup(Widget):
         """
         replacement.parent = self
         replacement._candy_stack = child._candy_id
+        if replacement.priority != self.priority:
+            replacement.set_priority(self.priority)
         if child in Widget._candy_sync_reparent:
             # The old child already is in replacement mode, put the
             # new one where the old one is. FIXME: there are some
             # strange reasons where this does not work as expected. I
             # have no idea why and it is hard to create.
             replacement._candy_stack = child._candy_stack
-            Widget._candy_sync_reparent.remove(replacement)
-            Widget._candy_sync_reparent.insert(Widget._candy_sync_reparent.index(child)+1, replacement)
+            Widget._candy_sync_reparent.insert_after(child, replacement)
             self.children.remove(replacement)
             self.children.insert(self.children.index(child), replacement)
         child.freeze_context = True
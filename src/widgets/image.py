@@ -33,18 +33,15 @@ __all__ = [ 'Image' ]
 # python imports
 import os
 import logging
-import hashlib
-import struct
 import tempfile
 
 # kaa imports
 import kaa
-import kaa.net.url
 import kaa.imlib2
 
 # kaa.candy imports
 from widget import Widget
-from .. import config
+from .. import config, imageinfo, download, diskcache
 
 # get logging object
 log = logging.getLogger('kaa.candy')
@@ -56,18 +53,28 @@ class Image(Widget):
     candyxml_name = 'image'
     candy_backend = 'candy.ImageTexture'
 
-    attributes = [ 'sync_data', 'modified', 'keep_aspect', 'load_async' ]
+    attributes = [ 'sync_data', 'modified', 'keep_aspect', 'load_async', 'image_size',
+                   'progressive', 'crossfade', 'priority' ]
 
     # image variables
     modified = True
     keep_aspect = False
     load_async = False
+    # size the backend should decode the image file at
+    image_size = None
+    # show a small version of JPEG files while the backend decodes the
+    # image and fade it out in crossfade seconds when the image is there
+    progressive = False
+    crossfade = 0
 
-    # class variable with a dict of images currently loading
-    __downloads = {}
+    # image formats loaded by the backend, other images are loaded
+    # with kaa.imlib2
+    backend_formats = [ 'jpeg', 'png', 'gif', 'bmp' ]
 
     __filename = None
     __image = None
+    # cache file of the remote image downloading
+    __download = None
 
     class _Info(object):
         def __init__(self, data, width, height):
@@ -112,6 +119,14 @@ class Image(Widget):
             else:
                 width = int(height * aspect)
             self.intrinsic_size = width, height
+        if isinstance(self.__image.data, (str, unicode)) and width > 0 and height > 0:
+            # Decode the file in the backend at the size on screen. A
+            # new decoding is only needed if the widget grows.
+            if not self.image_size or width > self.image_size[0] or height > self.image_size[1]:
+                if width < self.__image.width and height < self.__image.height:
+                    self.image_size = width, height
+                else:
+                    self.image_size = self.__image.width, self.__image.height
 
     def sync_prepare(self):
         """
@@ -122,14 +137,28 @@ class Image(Widget):
         if not self.__image:
             self.sync_data = None
         elif isinstance(self.__image.data, (str, unicode)):
-            self.sync_data = self.__image.data, False
+            filename = self.__image.data
+            if config.diskcache_variants and self.image_size and \
+                    self.image_size != (self.__image.width, self.__image.height) and \
+                    diskcache.images.managed(filename):
+                # use a downloaded image scaled to the size on screen
+                variant = diskcache.images.get_variant(filename, self.image_size)
+                if variant:
+                    filename = variant
+                else:
+                    diskcache.images.create_variant(filename, self.image_size).\
+                        connect_weak_once(self._variant_created, self.__image.data)
+            self.sync_data = filename, False
         else:
-            fd, filename = tempfile.mkstemp(prefix='candy', suffix='.png', dir='/dev/shm')
-            os.close(fd)
+            fd, filename = tempfile.mkstemp(prefix='candy', suffix='.raw', dir='/dev/shm')
             try:
-                # write the image data to shm
-                self.__image.data.save(filename)
-                self.sync_data = filename, True
+                # write the raw BGRA data to shm; the backend maps the
+                # file and uploads the pixels without decoding
+                image = self.__image.data
+                shm = os.fdopen(fd, 'wb')
+                shm.write(image.get_raw_data('BGRA'))
+                shm.close()
+                self.sync_data = filename, True, (image.width, image.height, image.width * 4)
             except Exception, e:
                 log.error('unable to save imlib2 image')
                 self.sync_data = None
@@ -151,17 +180,36 @@ class Image(Widget):
         """
         Return the cache filename for the given url
         """
-        base = hashlib.md5(url).hexdigest() + os.path.splitext(url)[1]
-        return kaa.tempfile('candy-images/' + base)
+        return diskcache.images.filename(url)
 
-    def _download_complete(self, status, cachefile):
+    def _download_complete(self, changed, cachefile):
         """
-        Callback for HTTP GET result. The image should be in the
-        cachefile.
+        Callback for the download manager. The image is in the
+        cachefile if changed is True.
         """
-        if cachefile in self.__downloads:
-            del self.__downloads[cachefile]
-        self.image = cachefile
+        if self.__download != cachefile:
+            # the widget shows a different image now
+            return
+        self.__download = None
+        if changed:
+            # force reloading a file updated on the server
+            self.__filename = None
+            self.image = cachefile
+
+    def _variant_created(self, created, filename):
+        """
+        Callback for the disk cache when the scaled image is stored
+        """
+        if created and self.__image and self.__image.data == filename:
+            self.modified = True
+
+    def set_priority(self, priority):
+        """
+        Set the priority for downloading a remote image
+        """
+        super(Image, self).set_priority(priority)
+        if self.__download:
+            download.set_priority(self.__download, priority)
 
     @property
     def image(self):
@@ -177,6 +225,7 @@ class Image(Widget):
         filename or url.
         """
         self.__image_provided = image
+        self.__download = None
         if image and isinstance(image, (str, unicode)) and image.startswith('$'):
             # variable from the context, e.g. $varname
             image = self.context.get(image) or ''
@@ -185,25 +234,17 @@ class Image(Widget):
             self.__image = Image._Info(image, image.width, image.height)
             self.modified = True
             return
-        if image and image.startswith('http://'):
-            # remote image, create local cachefile
-            # FIXME: how to handle updates on the remote side?
-            cachefile = self.get_cachefile(image)
-            if not os.path.isfile(cachefile):
-                # Download the image
-                # FIXME: errors will be dropped
-                # FIXME: support other remote sources
-                # FIXME: use one thread (jobserver) for all downloads
-                #  or at least a max number of threads to make the individual
-                #  image loading faster
-                if not cachefile in self.__downloads:
-                    tmpfile = cachefile + '.tmp'
-                    c = kaa.net.url.fetch(image, cachefile, tmpfile)
-                    self.__downloads[cachefile] = c
-                self.__downloads[cachefile].connect_weak_once(self._download_complete, cachefile)
-                image = None
-            else:
+        if image and image.startswith(('http://', 'https://')):
+            # remote image, download it into a local cachefile or
+            # check the cachefile for updates
+            cachefile, downloading = diskcache.images.fetch(image, self, self.priority)
+            if downloading is not None and not downloading.finished:
+                self.__download = cachefile
+                downloading.connect_weak_once(self._download_complete, cachefile)
+            if os.path.isfile(cachefile):
                 image = cachefile
+            else:
+                image = None
         if image and not image.startswith('/'):
             # try to locate the image in our image path
             image = self.search(image)
@@ -211,47 +252,19 @@ class Image(Widget):
             # unchanged filename
             return
         self.__filename = image
+        self.image_size = None
         if not image:
             # image is not valid
             log.error('invalid image: %s', self.__image_provided)
             self.__image = None
             self.modified = True
             return
-        iheight = iwidth = 0
         try:
-            # try to get the image geometry
-            fd = open(image)
-            if fd.read(2) == '\xff\xd8':
-                # image looks like a JPG file. Let us see if we can
-                # get the geometry from the metadata and then use the
-                # clutter backend to actually load the image
-                app = fd.read(4)
-                while (len(app) == 4):
-                    (ff,segtype,seglen) = struct.unpack(">BBH", app)
-                    if ff != 0xff or segtype == 0xd9:
-                        break
-                    if segtype >= 0xC0 and segtype <= 0xCF:
-                        iheight, iwidth = struct.unpack('>BHHB', fd.read(seglen-2)[:6])[1:3]
-                        break
-                    fd.seek(seglen-2,1)
-                    app = fd.read(4)
-            fd.seek(0)
-            if fd.read(8) == '\211PNG\r\n\032\n':
-                # image looks like a PNG file. Let us see if we can
-                # get the geometry from the metadata and then use the
-                # clutter backend to actually load the image
-                while True:
-                    (seglen, segtype) = struct.unpack('>I4s', fd.read(8))
-                    if segtype == 'IEND':
-                        break
-                    if segtype == 'IHDR':
-                        data = fd.read(seglen+4)
-                        iwidth, iheight = struct.unpack(">IIb", data[:9])[:2]
-                        break
-                    fd.seek(seglen+4,1)
-            if iheight > 0 and iwidth > 0:
+            # try to get the image geometry from the header
+            info = imageinfo.get_geometry(image)
+            if info and info[2] in Image.backend_formats:
                 # the backend can load the image itself
-                self.__image = Image._Info(image, iwidth, iheight)
+                self.__image = Image._Info(image, info[0], info[1])
             else:
                 # load using imlib2; the backend may not be able to
                 # load the image itself
@@ -260,12 +273,6 @@ class Image(Widget):
         except Exception, e:
             log.error('unable to load %s', image)
             self.__image = None
-        finally:
-            try:
-                fd.close()
-            except:
-                # if open failed, close will also fail
-                pass
         self.modified = True
 
     @classmethod
@@ -30,13 +30,9 @@
 
 __all__ = [ 'Label' ]
 
-# python
-import re
-import kaa.base
-
 # kaa.candy imports
 from widget import Widget
-from ..core import Color, Font
+from ..core import Color, Font, get_template
 
 class Label(Widget):
     """
@@ -50,8 +46,13 @@ class Label(Widget):
         'font': Font
     }
 
-    __text_regexp = re.compile('\$([a-zA-Z][a-zA-Z0-9_\.]*)|\${([^}]*)}')
     __text = None
+    # compiled template of the text and the text of its variables
+    __template = None
+    __template_chunks = None
+    # font without size to fit into the height and the font used for it
+    __font_fit = None
+    __font_fitted = None
 
     def __init__(self, pos=None, size=None, color=None, font=None, text='', condition=None, context=None):
         """
@@ -78,17 +79,18 @@ class Label(Widget):
     @text.setter
     def text(self, text):
         self.__text_provided = text
-        def replace_context(matchobj):
-            match = matchobj.groups()[0] or matchobj.groups()[1]
-            s = self.context.get(match, '')
-            if s is not None:
-                return kaa.base.py3_str(s, coerce=True)
-            return ''
+        template = chunks = None
         if self.context:
             if self._condition and not self.context.get(self._condition):
                 text = ''
-            # we have a context, use it
-            text = re.sub(self.__text_regexp, replace_context, text)
+            if '$' in text:
+                template = get_template(text)
+                chunks = template.evaluate(self.context)
+                if template is self.__template and chunks == self.__template_chunks:
+                    # nothing changed
+                    return
+                text = template.render(chunks)
+        self.__template, self.__template_chunks = template, chunks
         if self.__text == text:
             return
         self.__text = text
@@ -107,8 +109,16 @@ class Label(Widget):
         """
         super(Label, self).sync_layout(size)
         if self.font.size == 0:
-            # FIXME: wrong when the widget size changes
-            self.font = self.font.get_font(self.height)
+            self.__font_fit = self.font
+        elif self.font is not self.__font_fitted:
+            # a new font with a size was set
+            self.__font_fit = None
+        if self.__font_fit is not None:
+            # fit the font again when the height changes
+            font = self.__font_fit.get_font(self.height)
+            if font != self.font:
+                self.font = font
+            self.__font_fitted = self.font
         width, height = self.font.get_width(self.text), self.font.get_height(Font.MAX_HEIGHT)
         if self.width and width > self.width and self.width > 0:
             width = self.width
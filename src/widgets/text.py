@@ -30,15 +30,8 @@
 
 __all__ = [ 'Text' ]
 
-import re
-import kaa.base
-
-import cairo
-
-from gi.repository import Pango, PangoCairo
-
 from widget import Widget
-from ..core import Color, Font, create_cairo_context
+from ..core import Color, Font, get_template, measure_text
 
 
 class Text(Widget):
@@ -50,11 +43,10 @@ class Text(Widget):
         'font': Font
     }
 
-    __intrinsic_size_param = None
-    __intrinsic_size_cache = None
-
-    __text_regexp = re.compile('\$([a-zA-Z][a-zA-Z0-9_\.]*)|\${([^}]*)}')
     __text = None
+    # compiled template of the text and the text of its variables
+    __template = None
+    __template_chunks = None
 
     def __init__(self, pos, size, text, font, color, align=None, condition=None, context=None):
         """
@@ -82,17 +74,19 @@ class Text(Widget):
     @text.setter
     def text(self, text):
         self.__text_provided = text
-        def replace_context(matchobj):
-            match = matchobj.groups()[0] or matchobj.groups()[1]
-            s = self.context.get(match, '')
-            if s is not None:
-                return kaa.base.py3_str(s, coerce=True)
-            return ''
+        template = chunks = None
         if self.context:
             # we have a context, use it
             if self._condition and not self.context.get(self._condition):
                 text = ' '      # why does '' not work on update?
-            text = re.sub(self.__text_regexp, replace_context, text)
+            if '$' in text:
+                template = get_template(text)
+                chunks = template.evaluate(self.context)
+                if template is self.__template and chunks == self.__template_chunks:
+                    # nothing changed
+                    return
+                text = template.render(chunks)
+        self.__template, self.__template_chunks = template, chunks
         if self.__text == text:
             return
         self.__text = text
@@ -111,24 +105,9 @@ class Text(Widget):
         """
         super(Text, self).sync_layout(size)
         width, height = self.size
-        if self.__intrinsic_size_param == (width, height, self.text, self.font.name, self.font.size):
-            self.intrinsic_size = self.__intrinsic_size_cache
-            return self.__intrinsic_size_cache
-        cr = create_cairo_context()
-        layout = PangoCairo.create_layout(cr)
-        layout.set_width(width * Pango.SCALE)
-        layout.set_height(height * Pango.SCALE)
-        layout.set_ellipsize(Pango.EllipsizeMode.END)
-        layout.set_wrap(Pango.WrapMode.WORD_CHAR)
-        layout.set_font_description(self.font.get_font_description())
-        layout.set_text(self.text, -1)
-        PangoCairo.show_layout(cr, layout)
-        self.__intrinsic_size_cache = \
-            int(min(width, Pango.units_to_double(layout.get_size()[0]))), \
-            int(min(height, Pango.units_to_double(layout.get_size()[1])))
-        self.__intrinsic_size_param = (width, height, self.text, self.font.name, self.font.size)
-        self.intrinsic_size = self.__intrinsic_size_cache
-        return self.__intrinsic_size_cache
+        text_width, text_height = measure_text(self.font, self.text, width, height)
+        self.intrinsic_size = int(min(width, text_width)), int(min(height, text_height))
+        return self.intrinsic_size
 
     @classmethod
     def candyxml_parse(cls, element):
@@ -30,12 +30,213 @@
 
 __all__ = [ 'Thumbnail' ]
 
+# python imports
+import logging
+import weakref
+
 # kaa imports
+import kaa
 import kaa.beacon
 
 # kaa.candy imports
 from widget import Widget
 from image import Image
+from .. import config
+
+# get logging object
+log = logging.getLogger('kaa.candy')
+
+class ThumbnailRequest(object):
+    """
+    Thumbnail creation or item scan needed by one or more widgets
+    """
+    def __init__(self, key, target, scan, order):
+        self.key = key
+        # kaa.beacon.Thumbnail or kaa.beacon.Item to scan
+        self.target = target
+        self.scan = scan
+        self.order = order
+        # queued, running or done
+        self.state = 'queued'
+        # widget priority the request was sent to beacon with
+        self.sent = None
+        self.widgets = []
+
+    def get_widgets(self):
+        """
+        Return the widgets still waiting for the request
+        """
+        widgets = [ ref() for ref in self.widgets ]
+        widgets = [ w for w in widgets if w is not None ]
+        self.widgets = [ weakref.ref(w) for w in widgets ]
+        return widgets
+
+
+class ThumbnailQueue(object):
+    """
+    Requests to kaa.beacon from all Thumbnail widgets. Requests are
+    collected and sent once per mainloop step, visible widgets
+    first. Widgets waiting for the same thumbnail share the request
+    and only config.thumbnail_max requests are sent to beacon at the
+    same time.
+    """
+    def __init__(self):
+        self.requests = {}
+        # key of the request by widget
+        self.widgets = weakref.WeakKeyDictionary()
+        # requests sent to beacon and not finished
+        self.running = set()
+        self.counter = 0
+        self.timer = kaa.OneShotTimer(self.flush)
+        self.stats = { 'requested': 0, 'coalesced': 0, 'sent': 0, 'promoted': 0, 'demoted': 0 }
+
+    def create(self, widget, thumbnail):
+        """
+        Create the thumbnail for the widget
+        """
+        self._add(widget, ('thumbnail', thumbnail.name), thumbnail, False)
+
+    def scan(self, widget, item):
+        """
+        Scan the beacon item for the widget
+        """
+        self._add(widget, ('scan', item.url), item, True)
+
+    def release(self, widget):
+        """
+        The widget does not need its request anymore
+        """
+        key = self.widgets.pop(widget, None)
+        request = self.requests.get(key)
+        if request is not None:
+            request.widgets = [ ref for ref in request.widgets if ref() is not widget ]
+            self._schedule()
+
+    def update(self, widget):
+        """
+        The priority of the widget changed
+        """
+        if widget in self.widgets:
+            self._schedule()
+
+    def _add(self, widget, key, target, scan):
+        """
+        Add the widget to the request for key
+        """
+        self.release(widget)
+        request = self.requests.get(key)
+        if request is None:
+            self.counter += 1
+            request = self.requests[key] = ThumbnailRequest(key, target, scan, self.counter)
+            self.stats['requested'] += 1
+        else:
+            self.stats['coalesced'] += 1
+        request.widgets.append(weakref.ref(widget))
+        self.widgets[widget] = key
+        self._schedule()
+
+    def _schedule(self):
+        """
+        Flush the queue in the next mainloop step
+        """
+        if not self.timer.active:
+            self.timer.start(0)
+
+    def _send(self, request, priority):
+        """
+        Send the request to beacon or change the priority of a running
+        thumbnail creation.
+        """
+        if request.scan:
+            request.sent = priority
+            return request.target.scan()
+        thumbnail = request.target
+        if request.sent is not None:
+            self.stats['promoted' if priority < request.sent else 'demoted'] += 1
+        request.sent = priority
+        if priority == Widget.PRIORITY_NORMAL:
+            return thumbnail.create(thumbnail.PRIORITY_HIGH)
+        return thumbnail.create(thumbnail.PRIORITY_LOW)
+
+    def flush(self):
+        """
+        Drop requests nobody waits for, adjust the priority of running
+        requests and send the next ones.
+        """
+        waiting = []
+        for key, request in self.requests.items():
+            widgets = request.get_widgets()
+            if not widgets:
+                del self.requests[key]
+                if request.state == 'running' and not request.scan:
+                    # let beacon finish the thumbnail later
+                    self._send(request, Widget.PRIORITY_LOW)
+                self.running.discard(request)
+                continue
+            priority = min([ w.priority for w in widgets ])
+            if request.state == 'queued':
+                waiting.append((priority, request.order, request))
+            elif request.sent != priority and not request.scan:
+                self._send(request, priority)
+        waiting.sort()
+        for priority, order, request in waiting:
+            limit = config.thumbnail_max
+            if priority != Widget.PRIORITY_NORMAL:
+                # keep one slot for visible widgets
+                limit = max(1, limit - 1)
+            if len(self.running) >= limit:
+                break
+            inprogress = self._send(request, priority)
+            self.stats['sent'] += 1
+            if not inprogress:
+                # nothing to do for beacon
+                self._finished(None, request)
+                continue
+            if inprogress.finished:
+                # beacon already has the result
+                self._finished(None if inprogress.failed else inprogress.result, request)
+                continue
+            request.state = 'running'
+            self.running.add(request)
+            inprogress.connect_both(kaa.Callable(self._finished, request),
+                kaa.Callable(self._failed, request))
+
+    def _finished(self, result, request):
+        """
+        Callback from beacon
+        """
+        self.running.discard(request)
+        request.state = 'done'
+        if self.requests.get(request.key) is request:
+            del self.requests[request.key]
+        for widget in request.get_widgets():
+            if self.widgets.get(widget) != request.key:
+                continue
+            del self.widgets[widget]
+            if request.scan:
+                widget._beacon_update(result, request.target)
+            else:
+                widget._beacon_thumbnail_ready()
+        self._schedule()
+
+    def _failed(self, tp, exc, tb, request):
+        """
+        Error callback from beacon
+        """
+        log.error('%s failed: %s', 'scan' if request.scan else 'thumbnail', exc)
+        self._finished(None, request)
+
+    def get_stats(self):
+        """
+        Return the statistics of the queue
+        """
+        stats = self.stats.copy()
+        stats['queued'] = len(self.requests) - len(self.running)
+        stats['running'] = len(self.running)
+        return stats
+
+# requests of all thumbnail widgets
+thumbnail_queue = ThumbnailQueue()
 
 class Thumbnail(Image):
     """
@@ -63,6 +264,8 @@ class Thumbnail(Image):
         """
         self.__thumbnail_provided = thumbnail
         self.__default_provided = default
+        # drop the request for the old thumbnail
+        thumbnail_queue.release(self)
         if isinstance(thumbnail, (str, unicode)):
             # get thumbnail from context
             # FIXME: make this dynamic
@@ -79,9 +282,7 @@ class Thumbnail(Image):
             # show thumbnail
             self._beacon_thumbnail_ready(force=True)
         elif item is not None and not item.scanned:
-            scanning = item.scan()
-            if scanning:
-                scanning.connect_weak_once(self._beacon_update, item)
+            thumbnail_queue.scan(self, item)
 
     def sync_context(self):
         """
@@ -89,6 +290,13 @@ class Thumbnail(Image):
         """
         self.set_thumbnail(self.__thumbnail_provided, self.__default_provided)
 
+    def set_priority(self, priority):
+        """
+        Set the priority for creating the thumbnail
+        """
+        super(Thumbnail, self).set_priority(priority)
+        thumbnail_queue.update(self)
+
     def _beacon_update(self, changes, item):
         self._thumbnail = item.get('thumbnail')
         if self._thumbnail is not None:
@@ -106,14 +314,11 @@ class Thumbnail(Image):
         elif self._thumbnail.failed:
             return False
         if force and self._thumbnail.needs_update:
-            # Create thumbnail; This object will hold a reference to the
-            # beacon.Thumbnail object and uses high priority. Since we
-            # only connect weak to the result we loose the thumbnail object
-            # when this widget is removed which will reduce the priority
-            # to low. This is exactly what we want. The create will be
-            # scheduled in the mainloop but since we do not wait it is ok.
-            self._thumbnail.create(self._thumbnail.PRIORITY_HIGH).\
-                connect_weak_once(self._beacon_thumbnail_ready)
+            # Create the thumbnail with high priority while the widget
+            # is visible. The queue lowers the priority when the
+            # widget is deleted, gets a new thumbnail or scrolls out
+            # of the visible area.
+            thumbnail_queue.create(self, self._thumbnail)
 
     @classmethod
     def candyxml_parse(cls, element):
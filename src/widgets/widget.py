@@ -34,6 +34,7 @@ __all__ = [ 'XMLdict', 'Widget' ]
 import os
 import sys
 import logging
+import weakref
 
 # kaa imports
 import kaa
@@ -41,7 +42,7 @@ import kaa.weakref
 
 # kaa.candy imports
 from .. import candyxml
-from ..core import Context
+from ..core import Context, OrderedSet
 from ..template import Template
 
 # get logging object
@@ -97,18 +98,31 @@ class Widget(object):
     ALIGN_CENTER = 'center'
     ALIGN_SHRINK = 'shrink'
 
+    # priority for loading content like remote images; lower values
+    # are loaded first
+    PRIORITY_NORMAL = 0
+    PRIORITY_LOW = 1
+
     # internal class variables
-    _candy_sync_new = []
+    _candy_sync_new = OrderedSet()
     _candy_sync_delete = []
-    _candy_sync_reparent = []
+    _candy_sync_reparent = OrderedSet()
     _candy_import = []
     _candy_backends = {}
-    _candy_all_widgets = []
+    # all widgets by id as weak references
+    _candy_widget_index = {}
+    # widgets visited and changed in the current sync and the number
+    # of layout calculations done and skipped
+    _candy_sync_stats = { 'visited': 0, 'changed': 0, 'layout': 0, 'layout_cached': 0 }
+    # attributes without influence on the intrinsic size
+    _candy_no_layout = ('opacity', 'scale_x', 'scale_y', 'anchor_point', 'visible', 'priority')
 
     # internal object variables
     _candy_id = None
     _candy_dirty = True
     _candy_stack = None
+    _candy_in_layout = False
+    _candy_layout_dependents = None
     stage = None
 
     class __metaclass__(type):
@@ -149,6 +163,8 @@ class Widget(object):
 
     __parent = None
     __stage = None
+    # parent size used for the last layout calculation
+    __layout_size = None
 
     # attributes
     name = None
@@ -162,6 +178,7 @@ class Widget(object):
     anchor_point = 0, 0
 
     visible = True
+    priority = PRIORITY_NORMAL
 
     # if True, the context will not be updated by the parent
     freeze_context = False
@@ -174,8 +191,8 @@ class Widget(object):
         next_id += 1
         self.backend = BackendWrapper(self._candy_id)
         self.__weakref = kaa.weakref.weakref(self)
-        Widget._candy_all_widgets.append(self.__weakref)
-        Widget._candy_sync_new.append(self)
+        Widget._candy_widget_index[self._candy_id] = weakref.ref(self)
+        Widget._candy_sync_new.add(self)
         if pos is not None:
             self.x, self.y = pos
         if size is not None:
@@ -187,16 +204,31 @@ class Widget(object):
     def __setattr__(self, attr, value):
         if value and attr in self.attribute_types and not isinstance(value, self.attribute_types[attr]):
             value = self.attribute_types[attr](value)
+        if attr == 'name' and self.__parent:
+            # update the name index of the ancestors
+            remove = [ (self.name, self) ] if self.name else []
+            add = [ (value, self) ] if value else []
+            self._candy_update_names(remove, add)
+        if attr in ('xalign', 'yalign', 'reference_x', 'reference_y'):
+            # the alignment changes the geometry
+            changed = getattr(self, attr) != value
+            super(Widget, self).__setattr__(attr, value)
+            if changed:
+                self.queue_layout()
+            return
         super(Widget, self).__setattr__(attr, value)
-        if not self._candy_dirty and (attr in self.attributes):
-            self.queue_rendering()
+        if attr in self.attributes:
+            if attr in Widget._candy_no_layout:
+                self._candy_queue()
+            else:
+                self.queue_rendering()
 
     def __del__(self):
         if not hasattr(self, '_candy_id') or not Widget:
             # Python is shutting down, no need to clean anymore -- and
             # not possible.
             return
-        Widget._candy_all_widgets.remove(self.__weakref)
+        Widget._candy_widget_index.pop(self._candy_id, None)
         Widget._candy_sync_delete.append(self._candy_id)
         if self.__stage and not self.__stage._candy_dirty:
             self.__stage.queue_rendering()
@@ -214,13 +246,15 @@ class Widget(object):
         Internal function when the candy backend becomes invalid and
         needs to be restarted.
         """
-        if not self in Widget._candy_sync_new:
-            Widget._candy_sync_new.append(self)
-        if not self in Widget._candy_sync_reparent and self.parent:
-            Widget._candy_sync_reparent.append(self)
+        Widget._candy_sync_new.add(self)
+        parent = self.parent
+        if parent:
+            Widget._candy_sync_reparent.add(self)
         self._candy_dirty = True
         self.__stage = None
         self.__sync_cache = {}
+        if parent:
+            parent._candy_queue_child(self)
 
     def __sync__(self, tasks):
         """
@@ -229,8 +263,10 @@ class Widget(object):
         """
         if not self._candy_dirty:
             return False
+        Widget._candy_sync_stats['visited'] += 1
         if self._candy_events.get('create'):
             self._candy_events.pop('create')(self)
+        changed = False
         (x, y), (width, height) = self.intrinsic_geometry
         # check the position and set a new position on the backend if
         # needed. This does not result in a new rendering.
@@ -241,6 +277,7 @@ class Widget(object):
         if attributes:
             self.__sync_cache.update(attributes)
             tasks.append(('position', (self._candy_id, x, y)))
+            changed = True
         # check all other attributes and this will cause a
         # re-rendering. Even width and height change the widget on the
         # backend.
@@ -255,21 +292,65 @@ class Widget(object):
         if attributes:
             self.__sync_cache.update(attributes)
             tasks.append(('update', (self._candy_id, attributes)))
+            changed = True
+        if changed:
+            Widget._candy_sync_stats['changed'] += 1
         self._candy_dirty = False
         return True
 
     def queue_rendering(self):
         """
-        Queue sync
+        Queue sync for content changes. The parent only needs a new
+        layout if it depends on the intrinsic size of this widget or
+        if the size of this widget depends on its siblings.
         """
-        self.__intrinsic_size = None
-        # if self._candy_dirty:
-        #     return True
+        if not self._candy_in_layout:
+            self.__intrinsic_size = None
+        self._candy_queue(self.xalign == Widget.ALIGN_SHRINK or self.yalign == Widget.ALIGN_SHRINK or
+            self.reference_x != 'parent' or self.reference_y != 'parent')
+        self._candy_queue_dependents()
+        return False
+
+    def queue_layout(self):
+        """
+        Queue sync for geometry changes. The layout of the widget and
+        its parent must be calculated again.
+        """
+        if not self._candy_in_layout:
+            self.__intrinsic_size = None
+        self._candy_queue(True)
+        self._candy_queue_dependents()
+
+    def _candy_queue(self, layout=False):
+        """
+        Mark the widget dirty and add it to the children of the
+        parent to sync. If layout is True, the layout of the parent
+        depends on the change.
+        """
+        if self._candy_dirty and not layout:
+            return
         self._candy_dirty = True
         parent = self.parent
-        if parent:# and not parent._candy_dirty:
-            parent.queue_rendering()
-        return False
+        if parent:
+            parent._candy_queue_child(self, layout)
+
+    def _candy_queue_dependents(self):
+        """
+        Queue a new layout for the widgets depending on the size of
+        this widget.
+        """
+        for widget in self._candy_layout_dependents or []:
+            if widget:
+                widget.queue_layout()
+
+    def add_layout_dependent(self, widget):
+        """
+        Add a widget depending on the geometry of this widget which is
+        not its parent or child, e.g. a clone.
+        """
+        if self._candy_layout_dependents is None:
+            self._candy_layout_dependents = []
+        self._candy_layout_dependents.append(kaa.weakref.weakref(widget))
 
     def sync_context(self):
         """
@@ -277,6 +358,83 @@ class Widget(object):
         """
         pass
 
+    def set_priority(self, priority):
+        """
+        Set the priority for loading the content of the widget, e.g.
+        PRIORITY_LOW for widgets created before they are visible.
+        """
+        self.priority = priority
+
+    def _candy_named(self):
+        """
+        Return a list of (name, widget) for this widget and all its
+        children with a name.
+        """
+        if self.name:
+            return [ (self.name, self) ]
+        return []
+
+    def _candy_update_names(self, remove, add):
+        """
+        Remove and add (name, widget) pairs from the name index of all
+        ancestors.
+        """
+        if not remove and not add:
+            return
+        parent = self.__parent
+        while parent is not None and getattr(parent, '_candy_names', None) is not None:
+            names = parent._candy_names
+            for name, widget in remove:
+                names[name].remove(widget)
+                if not names[name]:
+                    del names[name]
+            for name, widget in add:
+                names.setdefault(name, []).append(widget)
+            parent = parent.parent
+
+    def _candy_layout_state(self):
+        """
+        Return the values calculated by sync_layout
+        """
+        return self.__width, self.__height, self.__intrinsic_size
+
+    def _candy_layout(self, size):
+        """
+        Call sync_layout if the size of the parent changed or the
+        layout is invalid. Changes during the calculation do not
+        invalidate the layout.
+        """
+        # only a variable width or height depends on the parent
+        key = (size[0] if self.__variable_width else None,
+               size[1] if self.__variable_height else None)
+        if self.__intrinsic_size is not None and self.__layout_size == key:
+            # geometry, content and parent size unchanged
+            Widget._candy_sync_stats['layout_cached'] += 1
+            return
+        Widget._candy_sync_stats['layout'] += 1
+        self._candy_in_layout = True
+        try:
+            self.sync_layout(size)
+        finally:
+            self._candy_in_layout = False
+        self.__layout_size = key
+
+    def _candy_sync_layout(self, size):
+        """
+        Call sync_layout and queue a sync if the geometry changed
+        """
+        state = self._candy_layout_state()
+        self._candy_layout(size)
+        self._candy_check_layout(state)
+
+    def _candy_check_layout(self, state):
+        """
+        Queue a sync if the layout is different to the given state
+        """
+        if self._candy_layout_state() != state:
+            self._candy_queue()
+            self._candy_queue_dependents()
+
     def sync_layout(self, (width, height)):
         """
         Sync layout changes and calculate intrinsic size based on the
@@ -371,9 +529,10 @@ class Widget(object):
 
     @x.setter
     def x(self, x):
+        if self.__x == x:
+            return
         self.__x = x
-        if not self._candy_dirty:
-            self.queue_rendering()
+        self._candy_queue(True)
 
     @property
     def y(self):
@@ -381,9 +540,10 @@ class Widget(object):
 
     @y.setter
     def y(self, y):
+        if self.__y == y:
+            return
         self.__y = y
-        if not self._candy_dirty:
-            self.queue_rendering()
+        self._candy_queue(True)
 
     @property
     def width(self):
@@ -394,19 +554,19 @@ class Widget(object):
 
     @width.setter
     def width(self, width):
-        self.__intrinsic_size = None
         if isinstance(width, (str, unicode)):
             # use percent values provided by the string
-            self.__variable_width = int(width[:-1])
-            self.__width = -1
+            variable, width = int(width[:-1]), -1
         elif width is None:
-            self.__variable_width = 100
-            self.__width = -1
+            variable, width = 100, -1
         else:
-            self.__variable_width = None
-            self.__width = width
-        if not self._candy_dirty:
-            self.queue_rendering()
+            variable = None
+        if variable == self.__variable_width and (variable or width == self.__width):
+            # unchanged
+            return
+        self.__variable_width = variable
+        self.__width = width
+        self.queue_layout()
 
     @property
     def height(self):
@@ -417,19 +577,19 @@ class Widget(object):
 
     @height.setter
     def height(self, height):
-        self.__intrinsic_size = None
         if isinstance(height, (str, unicode)):
             # use percent values provided by the string
-            self.__variable_height = int(height[:-1])
-            self.__height = -1
+            variable, height = int(height[:-1]), -1
         elif height is None:
-            self.__variable_height = 100
-            self.__height = -1
+            variable, height = 100, -1
         else:
-            self.__variable_height = None
-            self.__height = height
-        if not self._candy_dirty:
-            self.queue_rendering()
+            variable = None
+        if variable == self.__variable_height and (variable or height == self.__height):
+            # unchanged
+            return
+        self.__variable_height = variable
+        self.__height = height
+        self.queue_layout()
 
     @property
     def size(self):
@@ -442,16 +602,25 @@ class Widget(object):
     @property
     def intrinsic_size(self):
         if not self.__intrinsic_size:
-            if (self.__variable_width or self.__variable_height) and not self.parent.__intrinsic_size:
+            if (self.__variable_width or self.__variable_height or self.reference_x != 'parent' or
+                    self.reference_y != 'parent') and not self.parent.__intrinsic_size:
+                # the parent calculates the size
                 self.parent.intrinsic_size
             else:
-                self.sync_layout(self.parent.size)
+                self._candy_sync_layout(self.parent.size)
         return self.__intrinsic_size
 
     @intrinsic_size.setter
     def intrinsic_size(self, size):
         self.__intrinsic_size = size
 
+    @property
+    def _candy_layout_valid(self):
+        """
+        True if the intrinsic size is calculated and still valid
+        """
+        return self.__intrinsic_size is not None
+
     @property
     def intrinsic_geometry(self):
         """
@@ -476,20 +645,25 @@ class Widget(object):
     @parent.setter
     def parent(self, parent):
         self._candy_stack = None
-        if not self in Widget._candy_sync_reparent:
-            self.queue_rendering()
+        named = self._candy_named()
         if self.__parent:
             self.__parent.children.remove(self)
+            self.__parent._candy_dirty_children.discard(self)
+            self._candy_update_names(named, [])
+            # the children of the old parent changed
+            self.__parent._candy_queue_child(None, True)
         if parent:
             self.__parent = parent.__weakref
             self.__parent.children.append(self)
+            self._candy_update_names([], named)
         else:
             self.__parent = None
-        if not self in Widget._candy_sync_reparent:
-            if parent:
-                parent.queue_rendering()
-            Widget._candy_sync_reparent.append(self)
-            self.queue_rendering()
+        Widget._candy_sync_reparent.add(self)
+        # the size may depend on the new parent
+        self.__intrinsic_size = None
+        self._candy_dirty = True
+        if self.__parent:
+            self.__parent._candy_queue_child(self, True)
 
     @property
     def stage(self):
@@ -0,0 +1,78 @@
+# Compare the widget lookup by id and name using the index of the
+# widgets with the recursive search through all groups. The tree has
+# about 5,000 widgets: 50 groups with 10 sub-groups each holding 9
+# rectangles.
+
+import sys
+import time
+
+import kaa.candy
+
+def walk_by_id(group, wid):
+    """
+    Recursive search for the widget with the given id
+    """
+    for child in group.children:
+        if child._candy_id == wid:
+            return child
+        if isinstance(child, kaa.candy.AbstractGroup):
+            result = walk_by_id(child, wid)
+            if result is not None:
+                return result
+    return None
+
+def walk_by_name(group, name):
+    """
+    Recursive search for the widget with the given name
+    """
+    for child in group.children:
+        if child.name == name:
+            return child
+        if isinstance(child, kaa.candy.AbstractGroup):
+            result = walk_by_name(child, name)
+            if result is not None:
+                return result
+    return None
+
+def bench(name, func, args, loops):
+    t0 = time.time()
+    for i in range(loops):
+        for arg in args:
+            func(arg)
+    t = (time.time() - t0) / (loops * len(args))
+    print '  %-10s %9.3f us/lookup' % (name, t * 1000000)
+
+root = kaa.candy.Group(size=(800, 600))
+widgets = []
+for i in range(50):
+    group = kaa.candy.Group()
+    group.name = 'group-%s' % i
+    root.add(group)
+    widgets.append(group)
+    for j in range(10):
+        sub = kaa.candy.Group()
+        group.add(sub)
+        widgets.append(sub)
+        for k in range(9):
+            rect = kaa.candy.Rectangle(size=(10, 10))
+            rect.name = 'rect-%s-%s-%s' % (i, j, k)
+            sub.add(rect)
+            widgets.append(rect)
+print '%d widgets' % len(widgets)
+
+loops = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+# lookup the last widgets, the worst case for the tree walk
+ids = [ w._candy_id for w in widgets[-100:] ]
+names = [ w.name for w in widgets[-100:] if w.name ]
+
+for wid in ids:
+    assert root.get_widget_by_id(wid) is walk_by_id(root, wid)
+for name in names:
+    assert root.get_widget(name) is walk_by_name(root, name)
+
+print 'lookup by id'
+bench('walk', lambda wid: walk_by_id(root, wid), ids, loops)
+bench('index', root.get_widget_by_id, ids, loops)
+print 'lookup by name'
+bench('walk', lambda name: walk_by_name(root, name), names, loops)
+bench('index', root.get_widget, names, loops)
@@ -0,0 +1,63 @@
+# Compare a plain list with kaa.candy.core.OrderedSet for the access
+# pattern of the widget sync queues: add a widget if it is not in the
+# queue, remove widgets deleted before the sync and take the rest out
+# in order on the sync. The time per widget stays constant for the
+# OrderedSet while it grows with the number of widgets for the list.
+
+import sys
+import time
+import random
+
+from kaa.candy.core import OrderedSet
+
+class Item(object):
+    pass
+
+def run_list(items, removed):
+    queue = []
+    for item in items:
+        if not item in queue:
+            queue.append(item)
+    for item in removed:
+        queue.remove(item)
+    while queue:
+        queue.pop(0)
+
+def run_set(items, removed):
+    queue = OrderedSet()
+    for item in items:
+        if not item in queue:
+            queue.add(item)
+    for item in removed:
+        queue.remove(item)
+    while queue:
+        queue.pop()
+
+def bench(func, items, removed):
+    t0 = time.time()
+    func(items, removed)
+    return time.time() - t0
+
+sizes = [ int(x) for x in sys.argv[1:] ] or [ 1000, 2500, 5000, 10000 ]
+print '%8s %14s %14s' % ('widgets', 'list us/item', 'set us/item')
+for size in sizes:
+    items = [ Item() for i in range(size) ]
+    removed = random.sample(items, size / 2)
+    t_list = bench(run_list, items, removed)
+    t_set = bench(run_set, items, removed)
+    print '%8d %14.3f %14.3f' % (size, t_list * 1000000 / size, t_set * 1000000 / size)
+
+# the same with real widgets in a group
+import kaa.candy
+
+for size in sizes:
+    t0 = time.time()
+    group = kaa.candy.Group()
+    widgets = [ kaa.candy.Rectangle() for i in range(size) ]
+    group.add(*widgets)
+    for widget in widgets[::2]:
+        widget.parent = None
+    kaa.candy.Widget._candy_sync_new = OrderedSet()
+    kaa.candy.Widget._candy_sync_reparent = OrderedSet()
+    t = time.time() - t0
+    print 'create and remove %5d widgets: %8.3f us/widget' % (size, t * 1000000 / size)
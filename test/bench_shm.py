@@ -0,0 +1,63 @@
+# Compare the two ways to pass a kaa.imlib2 image to the backend for
+# a 1920x1080 image: saving it as PNG in /dev/shm and decoding it
+# again with GdkPixbuf in the backend against writing the raw BGRA
+# data into /dev/shm and mapping it in the backend. The upload to the
+# texture is the same for both and not part of the benchmark.
+
+import os
+import sys
+import mmap
+import time
+import tempfile
+
+import kaa.imlib2
+from gi.repository import GdkPixbuf
+
+WIDTH, HEIGHT = 1920, 1080
+
+def png_path(image):
+    """
+    Application: save as PNG, backend: decode the file
+    """
+    fd, filename = tempfile.mkstemp(prefix='candy', suffix='.png', dir='/dev/shm')
+    os.close(fd)
+    image.save(filename)
+    pixbuf = GdkPixbuf.Pixbuf.new_from_file(filename)
+    data = pixbuf.get_pixels()
+    os.unlink(filename)
+    return len(data)
+
+def shm_path(image):
+    """
+    Application: write the raw data, backend: map the file
+    """
+    fd, filename = tempfile.mkstemp(prefix='candy', suffix='.raw', dir='/dev/shm')
+    shm = os.fdopen(fd, 'wb')
+    shm.write(image.get_raw_data('BGRA'))
+    shm.close()
+    fd = os.open(filename, os.O_RDONLY)
+    data = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    os.close(fd)
+    os.unlink(filename)
+    size = len(data[:])
+    data.close()
+    return size
+
+def bench(name, func, image, loops):
+    t0, c0 = time.time(), time.clock()
+    for i in range(loops):
+        func(image)
+    wall = (time.time() - t0) / loops
+    cpu = (time.clock() - c0) / loops
+    print '  %-4s %8.2f ms round trip  %8.2f ms cpu' % (name, wall * 1000, cpu * 1000)
+
+# image with gradients and some noise similar to a rendered screen
+row = ''.join([ chr(x % 256) + chr((x / 8) % 256) + chr(128) + chr(255) for x in range(WIDTH) ])
+noise = os.urandom(WIDTH * 4)
+data = ''.join([ noise if y % 16 == 0 else row for y in range(HEIGHT) ])
+image = kaa.imlib2.new((WIDTH, HEIGHT), data)
+
+loops = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+print '%dx%d image, %d loops' % (WIDTH, HEIGHT, loops)
+bench('png', png_path, image, loops)
+bench('shm', shm_path, image, loops)
@@ -0,0 +1,51 @@
+# Change the text of 500 labels at once and report the time the
+# clutter thread spends on the text. Run it once with the default
+# worker threads and once with 'bench_text.py 0' to render the text in
+# the clutter thread on paint. Half of the labels show the same text
+# to show the effect of the shared cache.
+
+import sys
+import time
+
+import kaa
+import kaa.candy
+from kaa.candy import config
+
+LABELS = 500
+ROUNDS = 10
+
+if len(sys.argv) > 1:
+    config.text_threads = int(sys.argv[1])
+
+stage = kaa.candy.Stage((800, 600), 'bench-text')
+
+@kaa.coroutine()
+def main():
+    labels = []
+    for i in range(LABELS):
+        label = kaa.candy.Label((i % 10 * 80, i / 10 * 12), (78, 12), 0xcccccc, 'Vera:10')
+        stage.add(label)
+        labels.append(label)
+    yield kaa.delay(1)
+    t0 = time.time()
+    for n in range(ROUNDS):
+        for i, label in enumerate(labels):
+            if i % 2:
+                label.text = 'Round %s' % n
+            else:
+                label.text = 'Label %s in round %s' % (i, n)
+        yield kaa.delay(0.5)
+    stats = yield stage.get_stats()
+    print 'text_threads=%s, %s labels, %s rounds in %.1f sec' % \
+        (config.text_threads, LABELS, ROUNDS, time.time() - t0)
+    scheduler, text = stats['scheduler'], stats['text']
+    print '  frames: %(frames)d, overruns: %(overruns)d, deferred: %(deferred)d' % scheduler
+    print '  clutter thread: %(painted)d painted %(paint_time).3f ms, ' \
+        '%(uploaded)d uploaded %(upload_time).3f ms' % text
+    print '  worker threads: %(rendered)d rendered %(render_time).3f ms, ' \
+        '%(hits)d cache hits, %(cancelled)d cancelled' % text
+    print '  glyph cache: %(glyphs)d glyphs, %(hits)d hits, %(misses)d misses' % stats['glyphs']
+    kaa.main.stop()
+
+main()
+kaa.main.run()
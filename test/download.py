@@ -0,0 +1,134 @@
+# Test the download manager against a local HTTP server. The server
+# answers slowly to check the limit of concurrent downloads, supports
+# keep-alive connections and ETag revalidation, fails some requests
+# with 503 before they succeed and does not know some files.
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import BaseHTTPServer
+import SocketServer
+
+import kaa
+from kaa.candy import config, download
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    lock = threading.Lock()
+    active = 0
+    max_active = 0
+    requests = 0
+    # number of requests by path
+    paths = {}
+    failures = {}
+
+    def do_GET(self):
+        cls = Handler
+        cls.lock.acquire()
+        cls.active += 1
+        cls.requests += 1
+        cls.paths[self.path] = cls.paths.get(self.path, 0) + 1
+        cls.max_active = max(cls.max_active, cls.active)
+        cls.lock.release()
+        try:
+            time.sleep(0.05)
+            self.respond()
+        finally:
+            cls.lock.acquire()
+            cls.active -= 1
+            cls.lock.release()
+
+    def respond(self):
+        if self.path.startswith('/flaky'):
+            count = Handler.failures.get(self.path, 0)
+            if count < 2:
+                Handler.failures[self.path] = count + 1
+                return self.send(503, '')
+        if self.path.startswith('/missing'):
+            return self.send(404, '')
+        if self.path.startswith('/redirect'):
+            return self.send(302, '', Location='/image/redirected')
+        etag = '"%s"' % self.path
+        if self.headers.get('If-None-Match') == etag:
+            return self.send(304, '')
+        self.send(200, 'image data of %s' % self.path, ETag=etag)
+
+    def send(self, status, body, **headers):
+        self.send_response(status)
+        self.send_header('Content-Length', len(body))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class Owner(object):
+    pass
+
+
+def check(name, result):
+    print '  %-50s %s' % (name, 'ok' if result else 'FAILED')
+    if not result:
+        check.failed = True
+
+check.failed = False
+
+@kaa.coroutine()
+def main(url, cachedir):
+    owners = [ Owner() for i in range(20) ]
+    downloads = []
+    for i, owner in enumerate(owners):
+        # the second half is less important
+        filename = os.path.join(cachedir, '%s.jpg' % i)
+        downloads.append(download.fetch(url + '/image/%s' % i, filename, owner, i / 10))
+    # nobody waits for the last one anymore
+    del owners[-1], owner
+    flaky = download.fetch(url + '/flaky', os.path.join(cachedir, 'flaky.jpg'))
+    missing = download.fetch(url + '/missing', os.path.join(cachedir, 'missing.jpg'))
+    redirect = download.fetch(url + '/redirect', os.path.join(cachedir, 'redirect.jpg'))
+    t0 = time.time()
+    results = []
+    for inprogress in downloads + [ flaky, missing, redirect ]:
+        results.append((yield inprogress))
+    print 'downloaded in %.2f sec' % (time.time() - t0)
+    check('19 files downloaded', results[:19] == [ True ] * 19)
+    check('download without owner dropped', results[19] is False)
+    check('concurrent requests <= %s' % config.download_max,
+          Handler.max_active <= config.download_max)
+    stats = download.get_stats()
+    check('connections reused', stats['reused'] > 0 and stats['connections'] <= config.download_max + 3)
+    check('flaky file retried', results[20] is True and stats['retried'] >= 2)
+    check('missing file not retried', results[21] is False and Handler.paths.get('/missing') == 1)
+    check('redirect followed', results[22] is True)
+    check('second fetch uses the cache', download.fetch(url + '/image/0', os.path.join(cachedir, '0.jpg')) is None)
+    config.download_revalidate = 0
+    requests = Handler.requests
+    result = yield download.fetch(url + '/image/0', os.path.join(cachedir, '0.jpg'))
+    check('revalidation not modified', result is False and Handler.requests == requests + 1)
+    print stats
+    kaa.main.stop()
+
+server = Server(('127.0.0.1', 0), Handler)
+thread = threading.Thread(target=server.serve_forever)
+thread.daemon = True
+thread.start()
+
+cachedir = tempfile.mkdtemp()
+config.download_backoff = 0.1
+try:
+    main('http://127.0.0.1:%s' % server.server_address[1], cachedir)
+    kaa.main.run()
+finally:
+    shutil.rmtree(cachedir)
+sys.exit(1 if check.failed else 0)
@@ -0,0 +1,70 @@
+# Check the geometry the widgets send to the backend after layout and
+# content changes. The widgets are synced without a backend; a layer
+# with a dummy stage collects the tasks.
+
+import sys
+
+import kaa.candy
+
+class Stage(object):
+    size = (800, 600)
+    _candy_dirty = False
+
+    def queue_rendering(self):
+        pass
+
+    def _candy_queue_child(self, child, layout=False):
+        pass
+
+
+def sync(layer):
+    """
+    Return the attributes of the update tasks by widget id
+    """
+    layer.sync_prepare()
+    tasks = []
+    layer.__sync__(tasks)
+    return dict([ t[1] for t in tasks if t[0] == 'update' ])
+
+def check(name, result):
+    print '  %-50s %s' % (name, 'ok' if result else 'FAILED')
+    if not result:
+        check.failed = True
+
+check.failed = False
+
+layer = kaa.candy.Layer(size=(800, 600))
+layer.stage = Stage()
+group = kaa.candy.Group((0, 0), (400, 300))
+layer.add(group)
+a = kaa.candy.Rectangle((0, 0), (100, 20))
+b = kaa.candy.Rectangle((0, 0), ('100%', 10))
+b.reference_x = 'siblings'
+group.add(a, b)
+updates = sync(layer)
+check('sibling based width', updates[b._candy_id]['width'] == 100)
+
+b.color = 0xff0000
+updates = sync(layer)
+check('width unchanged on content change', updates[b._candy_id].get('width', 100) == 100)
+
+a.width = 150
+updates = sync(layer)
+check('width follows the siblings', updates[b._candy_id]['width'] == 150)
+
+shrink = kaa.candy.Group((0, 100))
+label = kaa.candy.Rectangle((0, 0), (50, 10))
+label.xalign = label.yalign = kaa.candy.Widget.ALIGN_SHRINK
+background = kaa.candy.Rectangle((0, 0), ('100%', '100%'))
+background.reference_x = background.reference_y = 'siblings'
+shrink.add(background, label)
+group.add(shrink)
+updates = sync(layer)
+check('background covers the siblings', updates[background._candy_id]['width'] == 50)
+
+background.color = 0x00ff00
+updates = sync(layer)
+check('background unchanged on content change',
+      updates[background._candy_id].get('width', 50) == 50)
+
+sys.exit(1 if check.failed else 0)